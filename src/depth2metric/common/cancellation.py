@@ -0,0 +1,35 @@
+import threading
+import time
+
+
+class RequestCancelled(Exception):
+    """Raised between pipeline stages when a request was abandoned or ran out of time."""
+
+    def __init__(self, reason: str, stage: str):
+        super().__init__(f"Request {reason} before {stage!r}.")
+        self.reason = reason
+        self.stage = stage
+
+
+class CancellationToken:
+    """Carries a request's deadline and cancellation state into worker threads."""
+
+    def __init__(self, timeout: float | None = None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.event = threading.Event()
+        self.reason = "cancelled"
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        self.reason = reason
+        self.event.set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def check(self, stage: str) -> None:
+        """Abort before a stage if the request was cancelled or its deadline passed."""
+        if self.event.is_set():
+            raise RequestCancelled(self.reason, stage)
+        if self.expired:
+            raise RequestCancelled("expired", stage)
@@ -1,4 +1,18 @@
-from prometheus_client import Counter, Histogram
+import os
+import sys
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Set for every worker process to aggregate metrics across workers on scrape
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
 
 # Histograms for latencies
 INFERENCE_LATENCY = Histogram(
@@ -8,6 +22,14 @@ INFERENCE_LATENCY = Histogram(
     buckets=(0.1, 0.25, 0.5, 0.75, 1.0, 2.0, 5.0, 10.0, float("inf")),
 )
 
+# Histogram for the run time of each scaling strategy, all of them run on every image
+SCALING_STRATEGY_LATENCY = Histogram(
+    "depth2metric_scaling_strategy_latency_seconds",
+    "Latency of scale estimation strategies in seconds",
+    ["method"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float("inf")),
+)
+
 # Counter for scaling methods used
 SCALING_METHOD_TOTAL = Counter(
     "depth2metric_scaling_method_total",
@@ -35,3 +57,89 @@ MANUAL_CALIBRATION_TOTAL = Counter(
     "depth2metric_manual_calibration_total",
     "Total count of manual scale corrections by users",
 )
+
+# Counter for requests abandoned by clients or past their deadline
+CANCELLED_REQUESTS_TOTAL = Counter(
+    "depth2metric_cancelled_requests_total",
+    "Total count of requests whose remaining work was skipped",
+    ["reason", "stage"], # reason is disconnected or expired
+)
+
+# Spatial index size and query latencies
+SPATIAL_INDEX_SIZE_BYTES = Histogram(
+    "depth2metric_spatial_index_size_bytes",
+    "Approximate memory used by the spatial index of a result in bytes",
+    buckets=(100000, 500000, 1000000, 2000000, 5000000, 10000000, float("inf")),
+)
+
+SPATIAL_QUERY_LATENCY = Histogram(
+    "depth2metric_spatial_query_latency_seconds",
+    "Latency of batched spatial index queries in seconds",
+    ["query"], # pick, knn, radius or planes
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, float("inf")),
+)
+
+# Process resource gauges, one series per worker (pid label in multiprocess mode)
+PROCESS_RSS_BYTES = Gauge(
+    "depth2metric_process_resident_memory_bytes",
+    "Resident set size of the worker process in bytes",
+    multiprocess_mode="liveall",
+)
+
+TORCH_THREADS = Gauge(
+    "depth2metric_torch_threads",
+    "Number of torch threads used by the worker process",
+    ["kind"], # intraop or interop
+    multiprocess_mode="liveall",
+)
+
+# Request load gauges, summed over live workers
+IN_FLIGHT_REQUESTS = Gauge(
+    "depth2metric_in_flight_requests",
+    "Number of HTTP requests currently being handled",
+    multiprocess_mode="livesum",
+)
+
+EXECUTOR_QUEUE_LENGTH = Gauge(
+    "depth2metric_executor_queue_length",
+    "Number of jobs submitted to the executor that haven't started yet",
+    multiprocess_mode="livesum",
+)
+
+
+def get_rss_bytes() -> int:
+    """Current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not on Linux, fall back to the peak RSS (bytes on macOS, kilobytes elsewhere)
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def update_process_metrics() -> None:
+    import torch
+
+    PROCESS_RSS_BYTES.set(get_rss_bytes())
+    TORCH_THREADS.labels(kind="intraop").set(torch.get_num_threads())
+    TORCH_THREADS.labels(kind="interop").set(torch.get_num_interop_threads())
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    """Render metrics of this process, or of all workers in multiprocess mode."""
+    update_process_metrics()
+
+    if MULTIPROC_DIR is None:
+        return generate_latest(), CONTENT_TYPE_LATEST
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead() -> None:
+    """Remove this worker's live gauge files on exit."""
+    if MULTIPROC_DIR is not None:
+        multiprocess.mark_process_dead(os.getpid())
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Any
 
 from pydantic import DirectoryPath, Field
@@ -23,19 +24,45 @@ class Settings(BaseSettings):
     models_dir: DirectoryPath = Field("./models") # type: ignore
     samples_dir: DirectoryPath = Field("./static/samples") # type: ignore
     precomputed_dir: str = Field("./static/precomputed")
+    precompute_on_startup: bool = Field(True)
+    metrics_update_interval: float = Field(5.0)
+
+    # Requests
+    request_timeout: float = Field(60.0)
+    disconnect_poll_interval: float = Field(0.25)
+
+    # Results
+    result_cache_size: int = Field(16)
+    result_cache_bytes: int = Field(512 * 1024 * 1024)
+    results_dir: str | None = Field(None)
+    max_measure_pairs: int = Field(1000)
+    max_spatial_queries: int = Field(256)
+    max_spatial_neighbours: int = Field(64)
 
     # Models
     midas_model: str = Field("DPT_Hybrid")
     yolo_model: str = Field("yolo26n")
 
+    # Deterministic stand-ins for load testing without the real models
+    stub_models: bool = Field(False)
+    stub_midas_latency: float = Field(0.35)
+    stub_yolo_latency: float = Field(0.04)
+
     # Scaling & Geometry
     assumed_camera_height: float = Field(160.0)
     voxel_size: float = Field(0.7)
+    min_voxel_size: float = Field(0.2)
+    target_points: int | None = Field(None)
+    target_bytes: int | None = Field(None)
+    depth_transport_width: int = Field(640)
+    depth_step: float = Field(0.1)
+    roi_padding: float = Field(0.1)
     ransac_distance_threshold: float = Field(0.5)
     ransac_n: int = Field(10)
     ransac_iterations: int = Field(500)
     ground_vertical_threshold: float = Field(0.75)
     fallback_scale_factor: float = Field(0.3)
+    scaling_sample_size: int = Field(50_000)
 
     # Edge Case Fixes
     enable_edge_cropping: bool = Field(True)
@@ -54,5 +81,7 @@ class Settings(BaseSettings):
     )
 
 
-def get_settings():
+@lru_cache
+def get_settings() -> Settings:
+    """Parse the settings once and share them between modules."""
     return Settings() # type: ignore
@@ -41,6 +41,11 @@ def intrinsics_from_exif(
     }
 
 
+def crop_intrinsics(K: dict[str, float], x0: int, y0: int) -> dict[str, float]:
+    """Shift the principal point for a crop starting at (x0, y0)."""
+    return {**K, "cx": K["cx"] - x0, "cy": K["cy"] - y0}
+
+
 def fallback_intrinsics(width: int, height: int) -> dict[str, float]:
     """Basic intrinsics for pinhole camera."""
     return {
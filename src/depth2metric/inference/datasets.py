@@ -1,22 +1,44 @@
+import csv
+import json
 import os
 
 import cv2
-import pandas as pd
+import numpy as np
 import torch
 import torchvision.transforms.v2 as T
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
 from torchvision.io.image import decode_image
 
+SHARD_INDEX_FILE = "index.json"
+
 
 class NYUDataset(Dataset):
 
-    def __init__(self, data_path, transforms=None, load_with_opencv=False):
+    def __init__(
+        self,
+        data_path,
+        transforms=None,
+        load_with_opencv=False,
+        csv_name="nyu2_train.csv",
+        shards_dir=None,
+    ):
         super().__init__()
 
-        csv_path = os.path.join(data_path, "nyu2_train.csv")
-        self.df = pd.read_csv(
-            csv_path, names=["color_image", "depth_image"]
-        ).map(lambda s: os.path.join(data_path, s[5:]))
+        self.shards_dir = shards_dir
+        self.shards = None
+
+        if shards_dir is not None:
+            # Samples are read from pre-decoded shards, no CSV or per-item decode needed
+            with open(os.path.join(shards_dir, SHARD_INDEX_FILE)) as f:
+                self.index = json.load(f)
+            self.paths = None
+        else:
+            csv_path = os.path.join(data_path, csv_name)
+            with open(csv_path, newline="") as f:
+                self.paths = [
+                    (os.path.join(data_path, color[5:]), os.path.join(data_path, depth[5:]))
+                    for color, depth in csv.reader(f)
+                ]
 
         self.load_with_opencv = load_with_opencv
 
@@ -29,18 +51,118 @@ class NYUDataset(Dataset):
             self.transforms = transforms
 
     def __len__(self):
-        return len(self.df)
+        if self.paths is None:
+            return self.index["count"]
+        return len(self.paths)
 
-    def __getitem__(self, index):
-        color_path, depth_path = self.df.iloc[index].to_list()
+    def __getstate__(self):
+        # Memory maps are opened lazily in each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def open_shards(self):
+        self.shards = [
+            (
+                np.load(os.path.join(self.shards_dir, shard["color"]), mmap_mode="c"),
+                np.load(os.path.join(self.shards_dir, shard["depth"]), mmap_mode="c"),
+            )
+            for shard in self.index["shards"]
+        ]
+
+    def read_from_shards(self, index):
+        if self.shards is None:
+            self.open_shards()
 
-        if self.load_with_opencv:
-            color_image = cv2.imread(color_path, cv2.IMREAD_COLOR_RGB)
-            depth_image = cv2.imread(depth_path, cv2.IMREAD_COLOR_RGB)
+        shard_idx, offset = divmod(index, self.index["shard_size"])
+        color_shard, depth_shard = self.shards[shard_idx]
+
+        return color_shard[offset], depth_shard[offset]
+
+    def __getitem__(self, index):
+        if self.paths is None:
+            color_image, depth_image = self.read_from_shards(index)
         else:
-            color_image = decode_image(color_path)
-            depth_image = decode_image(depth_path)
+            color_path, depth_path = self.paths[index]
+
+            if self.load_with_opencv:
+                color_image = cv2.imread(color_path, cv2.IMREAD_COLOR_RGB)
+                depth_image = cv2.imread(depth_path, cv2.IMREAD_UNCHANGED)
+            else:
+                color_image = decode_image(color_path)
+                depth_image = decode_image(depth_path)
 
         tr_color_image, tr_depth_image = self.transforms(color_image), self.transforms(depth_image)
 
         return color_image, tr_color_image, depth_image, tr_depth_image
+
+
+def build_shards(
+    data_path: str,
+    shards_dir: str,
+    csv_name: str = "nyu2_train.csv",
+    shard_size: int = 1024,
+    num_workers: int = 4,
+) -> dict:
+    """Decode the dataset once into fixed-size memory-mapped shards (uint8 color, uint16 depth)."""
+    dataset = NYUDataset(
+        data_path,
+        transforms=torch.nn.Identity(),
+        load_with_opencv=True,
+        csv_name=csv_name,
+    )
+    loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+
+    os.makedirs(shards_dir, exist_ok=True)
+    count = len(dataset)
+
+    index = {"count": count, "shard_size": shard_size, "shards": []}
+    color_shard, depth_shard = None, None
+
+    for i, (color_image, _, depth_image, _) in enumerate(loader):
+        color_image, depth_image = np.asarray(color_image), np.asarray(depth_image)
+        if depth_image.ndim == 3:
+            depth_image = depth_image[..., 0]
+
+        if i == 0:
+            index["color_shape"] = list(color_image.shape)
+            index["depth_shape"] = list(depth_image.shape)
+
+        # Shards hold fixed-size samples, so odd-sized images are resized to the first sample
+        h, w = index["color_shape"][:2]
+        if color_image.shape[:2] != (h, w):
+            color_image = cv2.resize(color_image, (w, h), interpolation=cv2.INTER_LINEAR)
+        h, w = index["depth_shape"]
+        if depth_image.shape != (h, w):
+            depth_image = cv2.resize(depth_image, (w, h), interpolation=cv2.INTER_NEAREST)
+
+        shard_idx, offset = divmod(i, shard_size)
+        if offset == 0:
+            n = min(shard_size, count - i)
+            shard = {
+                "color": f"color_{shard_idx:05d}.npy",
+                "depth": f"depth_{shard_idx:05d}.npy",
+                "count": n,
+            }
+            index["shards"].append(shard)
+
+            color_shard = np.lib.format.open_memmap(
+                os.path.join(shards_dir, shard["color"]),
+                mode="w+", dtype=np.uint8, shape=(n, *index["color_shape"]),
+            )
+            depth_shard = np.lib.format.open_memmap(
+                os.path.join(shards_dir, shard["depth"]),
+                mode="w+", dtype=np.uint16, shape=(n, *index["depth_shape"]),
+            )
+
+        color_shard[offset] = color_image
+        depth_shard[offset] = depth_image
+
+        if offset == shard_size - 1 or i == count - 1:
+            color_shard.flush()
+            depth_shard.flush()
+
+    with open(os.path.join(shards_dir, SHARD_INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=2)
+
+    return index
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def median_scale(
+    pred: np.ndarray,
+    gt: np.ndarray,
+    mask: np.ndarray,
+) -> np.ndarray:
+    """Align a relative prediction to the ground truth using the ratio of medians."""
+    ratio = np.median(gt[mask]) / np.median(pred[mask])
+    return pred * ratio
+
+
+def compute_depth_metrics(
+    pred: np.ndarray,
+    gt: np.ndarray,
+    min_depth: float = 1e-3,
+    max_depth: float = 10.0,
+) -> dict[str, float]:
+    """Compute AbsRel, RMSE and δ<1.25 over valid pixels after median scaling."""
+    mask = (gt > min_depth) & (gt < max_depth) & (pred > 0)
+    if not mask.any():
+        raise ValueError("No valid pixels to evaluate.")
+
+    pred = median_scale(pred, gt, mask)
+    pred = np.clip(pred[mask], min_depth, max_depth)
+    gt = gt[mask]
+
+    thresh = np.maximum(gt / pred, pred / gt)
+
+    return {
+        "abs_rel": float(np.mean(np.abs(gt - pred) / gt)),
+        "rmse": float(np.sqrt(np.mean((gt - pred) ** 2))),
+        "delta1": float(np.mean(thresh < 1.25)),
+    }
+
+
+def pareto_front(rows: list[dict], cost_key: str, error_key: str) -> list[bool]:
+    """Flag rows not dominated by any other row (lower cost and lower error are better)."""
+    flags = []
+    for row in rows:
+        dominated = any(
+            other[cost_key] <= row[cost_key]
+            and other[error_key] <= row[error_key]
+            and (other[cost_key] < row[cost_key] or other[error_key] < row[error_key])
+            for other in rows
+        )
+        flags.append(not dominated)
+    return flags
@@ -1,6 +1,4 @@
 import numpy as np
-import open3d as o3d
-from ultralytics.engine.results import Results
 
 from depth2metric.common.settings import get_settings
 from depth2metric.common.utils import get_logger
@@ -40,6 +38,87 @@ def get_pcd_points(depth_map: np.ndarray, K: dict[str, float] | None = None) ->
     return points.reshape(-1, points.shape[2])
 
 
+def count_occupied_voxels(points: np.ndarray, voxel_size: float) -> int:
+    """Number of points a voxel grid downsampling of the points would produce."""
+    keys = np.floor(points / voxel_size).astype(np.int64)
+    keys -= keys.min(axis=0)
+    dims = keys.max(axis=0) + 1
+    flat = (keys[:, 0] * dims[1] + keys[:, 1]) * dims[2] + keys[:, 2]
+    return len(np.unique(flat))
+
+
+def estimate_occupied_voxels(grid: np.ndarray, stride: int, voxel_size: float) -> float:
+    """Estimate the voxel count of the full cloud from a (rows, cols, 3) grid sampled every stride pixels.
+
+    The count is also taken at twice the stride, and both are fit to N = A / (v^2 + c * s^2),
+    the occupancy of a surface sampled with spacing s by voxels of size v, to extrapolate
+    to every pixel.
+    """
+    count = count_occupied_voxels(grid.reshape(-1, 3), voxel_size)
+    if stride == 1:
+        return count
+
+    coarse = count_occupied_voxels(grid[::2, ::2].reshape(-1, 3), voxel_size)
+    x, y = 1 / count, 1 / coarse
+    inverse = (4 * x - y) / 3 + (y - x) / (3 * stride ** 2)
+
+    # Saturated samples can grow at most with the number of pixels
+    limit = count * stride ** 2
+    return limit if inverse <= 0 else min(1 / inverse, limit)
+
+
+def estimate_voxel_size(
+    points: np.ndarray,
+    shape: tuple[int, int],
+    target_points: int,
+    min_size: float = settings.min_voxel_size,
+    sample_size: int = 32_768,
+    iterations: int = 8,
+    tolerance: float = 0.05,
+) -> float:
+    """Estimate the smallest voxel size that downsamples the points to at most target_points.
+
+    Occupancy is estimated from a strided pixel grid of the (h * w, 3) points. The voxel
+    count of a surface falls with the square of the voxel size, so that model brackets the
+    size, which is then refined by interpolating the counts in log space.
+    """
+    h, w = shape
+    stride = max(1, int(np.ceil(np.sqrt(h * w / sample_size))))
+    grid = points.reshape(h, w, 3)[::stride, ::stride]
+
+    def estimate(voxel_size: float) -> float:
+        return estimate_occupied_voxels(grid, stride, voxel_size)
+
+    lo, lo_count = min_size, estimate(min_size)
+    if lo_count <= target_points:
+        return min_size
+
+    # Saturated or volumetric counts fall faster than the model, so always grow by half at least
+    hi, hi_count = lo, lo_count
+    while hi_count > target_points:
+        lo, lo_count = hi, hi_count
+        hi = hi * max(1.5, np.sqrt(hi_count / target_points))
+        hi_count = estimate(hi)
+
+    goal = np.log(target_points * (1 - tolerance / 2))
+    for _ in range(iterations):
+        if hi_count >= target_points * (1 - tolerance):
+            break
+
+        # Interpolate log count over log size, kept away from the ends so the bracket shrinks
+        weight = (np.log(lo_count) - goal) / (np.log(lo_count) - np.log(hi_count))
+        weight = float(np.clip(weight, 0.1, 0.9))
+        mid = float(lo * (hi / lo) ** weight)
+
+        count = estimate(mid)
+        if count > target_points:
+            lo, lo_count = mid, count
+        else:
+            hi, hi_count = mid, count
+
+    return float(hi)
+
+
 def distance_between_pixels(
     p1: tuple[int, int],
     p2: tuple[int, int],
@@ -56,112 +135,53 @@ def distance_between_pixels(
     return float(np.linalg.norm(P1 - P2))
 
 
-def get_scale_from_detections(
+def distances_between_pixels(
+    pairs: np.ndarray,
     depth_map: np.ndarray,
-    detections: Results,
     K: dict[str, float],
-    conf_threshold: float = 0.5,
-) -> tuple[float | None, float]:
-    """Use detected scene priors to calculate scale. Returns (scale, avg_conf)."""
-    scales = []
-    confs = []
-    priors = settings.size_priors
-
-    for box, cls, conf in zip(
-        detections.boxes.xyxy,
-        detections.boxes.cls,
-        detections.boxes.conf
-    ):
-        cls = int(cls.item())
-        conf_val = float(conf.item())
-
-        if cls in priors and conf_val >= conf_threshold:
-            # Calculate the mid-top and mid-bottom points
-            x_min, y_min, x_max, y_max = box
-            x_c = int((x_min + x_max) / 2)
-            y_min, y_max = int(y_min), int(y_max)
-
-            P_bottom = pixel_to_3d(x_c, y_min, depth_map[y_min, x_c], K)
-            P_top = pixel_to_3d(x_c, y_max, depth_map[y_max, x_c], K)
-
-            h_rel = np.abs(P_top[1] - P_bottom[1]) # Distance of the vertical only
-            s = priors[cls][1] / h_rel
-            scales.append(s)
-            confs.append(conf_val)
-            logger.debug(f"Using a detected {priors[cls][0]!r} with confidence {conf_val:.3f} for scale.")
-
-    if len(scales) == 0:
-        logger.debug("Found no usable detections.")
-        return None, 0.0
-
-    return float(np.median(scales)), float(np.mean(confs))
-
-
-def get_scale_from_image_bottom(
-    pcd_points: np.ndarray,
-    bottom_factor: float = 0.05,
-    camera_height: float = settings.assumed_camera_height,
-) -> float:
-    """Use the bottom of the image (assumed ground) and assumed camera height to calculate scale."""
-    h, _ = pcd_points.shape
-    points_slice = int(-bottom_factor * h)
-    points = pcd_points[points_slice:]
-
-    distances = np.linalg.norm(points, axis=1)
-    median = np.median(distances)
-    median_point_idx = np.abs(median - distances).argmin()
-    median_point = points[median_point_idx]
-
-    camera = np.zeros(3)
-    hyp = np.linalg.norm(camera - median_point)
-
-    camera[1] = median_point[1]
-    hor = np.linalg.norm(camera - median_point)
-
-    ver = ((hyp ** 2) - (hor ** 2)) ** 0.5
-    return float(camera_height / ver)
-
-
-def get_scale_from_ground_plane(
-    pcd: o3d.geometry.PointCloud,
-    camera_height: float = settings.assumed_camera_height,
-) -> float | None:
-    """Use a segmented vertical plane (assumed ground) and assumed camera height to calculate scale."""
-
-    # IMPROVEMENT: Pre-filter points for RANSAC
-    # We expect the ground to be below the camera (Y < 0) and not too far away
-    points = np.asarray(pcd.points)
-
-    # Keep only points that are likely to be ground (heuristic)
-    # 1. Below camera center (Y < 0 in our coordinate system where Y-up is negative)
-    # 2. Within a reasonable distance (e.g., 50m relative units)
-    mask = (points[:, 1] < 0) & (np.linalg.norm(points, axis=1) < 5000)
-
-    if np.sum(mask) < settings.ransac_n:
-        logger.debug("Not enough points after filtering for ground plane detection.")
-        return None
-
-    filtered_pcd = pcd.select_by_index(np.where(mask)[0])
-
-    try:
-        [a, b, c, d], _ = filtered_pcd.segment_plane(
-            distance_threshold=settings.ransac_distance_threshold,
-            ransac_n=settings.ransac_n,
-            num_iterations=settings.ransac_iterations,
-        )
-    except Exception as e:
-        logger.debug(f"RANSAC plane segmentation failed: {e}")
+) -> np.ndarray:
+    """Calculate the 3D distances of an (N, 4) array of (u1, v1, u2, v2) pixel pairs."""
+    U = pairs[:, [0, 2]]
+    V = pairs[:, [1, 3]]
+
+    Z = depth_map[V, U]
+    X = (U - K["cx"]) * Z / K["fx"]
+    Y = (V - K["cy"]) * Z / K["fy"]
+
+    P = np.stack([X, Y, Z], axis=-1)
+    return np.linalg.norm(P[:, 0] - P[:, 1], axis=1)
+
+
+def clip_roi(
+    roi: tuple[int, int, int, int],
+    width: int,
+    height: int,
+) -> tuple[int, int, int, int] | None:
+    """Clip an (x0, y0, x1, y1) rectangle to the image. Returns None if nothing is left."""
+    x0, y0, x1, y1 = roi
+    x0, x1 = max(0, min(x0, x1)), min(width, max(x0, x1))
+    y0, y1 = max(0, min(y0, y1)), min(height, max(y0, y1))
+
+    if x1 - x0 < 2 or y1 - y0 < 2:
         return None
-
-    plane = np.array([a, b, c])
-    normal = np.linalg.norm(plane)
-
-    units = plane / normal
-    # Check if the plane is horizontal enough (aligned with Y axis)
-    if abs(units[1]) < settings.ground_vertical_threshold:
-        logger.debug("The detected plane isn't horizontal enough.")
+    return x0, y0, x1, y1
+
+
+def get_roi_from_detections(
+    boxes: np.ndarray,
+    cls: int,
+    width: int,
+    height: int,
+    padding: float = settings.roi_padding,
+) -> tuple[int, int, int, int] | None:
+    """Padded box of the most confident detection of a class, or None if it wasn't detected."""
+    boxes = boxes[boxes[:, 4] == cls]
+    if len(boxes) == 0:
+        logger.debug(f"No detections of class {cls} to focus on.")
         return None
 
-    height_to_origin = abs(d) / normal
+    x0, y0, x1, y1 = boxes[boxes[:, 5].argmax(), :4]
+    pad_x, pad_y = (x1 - x0) * padding, (y1 - y0) * padding
+    roi = (int(x0 - pad_x), int(y0 - pad_y), int(np.ceil(x1 + pad_x)), int(np.ceil(y1 + pad_y)))
 
-    return camera_height / height_to_origin
+    return clip_roi(roi, width, height)
@@ -1,26 +1,34 @@
 # type: ignore
 
+from __future__ import annotations
+
 import os
 from collections.abc import Callable
+from typing import TYPE_CHECKING
 
 import cv2
 import numpy as np
-import torch
-from ultralytics import YOLO
-from ultralytics.engine.results import Results
-from ultralytics.utils import LOGGER as YOLO_LOGGER
 
 from depth2metric.common.settings import get_settings
 from depth2metric.common.utils import get_logger
+from depth2metric.inference.stubs import StubMidas, StubTransform, StubYolo
+
+if TYPE_CHECKING:
+    from ultralytics import YOLO
+    from ultralytics.engine.results import Results
 
 logger = get_logger(__name__)
 settings = get_settings()
 
-YOLO_LOGGER.setLevel(40) # Suppress YOLO output
-
 
 def get_midas(model_name: str | None = None) -> tuple[Callable, Callable]:
     """Load MiDaS model and related transforms."""
+    if settings.stub_models:
+        logger.info("Using stub MiDaS model.")
+        return StubMidas(settings.stub_midas_latency), StubTransform()
+
+    import torch
+
     if model_name is None:
         model_name = settings.midas_model
 
@@ -37,6 +45,15 @@ def get_midas(model_name: str | None = None) -> tuple[Callable, Callable]:
 
 
 def get_yolo(model_name: str | None = None) -> YOLO:
+    if settings.stub_models:
+        logger.info("Using stub YOLO model.")
+        return StubYolo(settings.stub_yolo_latency)
+
+    from ultralytics import YOLO
+    from ultralytics.utils import LOGGER as YOLO_LOGGER
+
+    YOLO_LOGGER.setLevel(40) # Suppress YOLO output
+
     if model_name is None:
         model_name = settings.yolo_model
 
@@ -55,8 +72,23 @@ def get_detections(model: YOLO, image: np.ndarray) -> Results | None:
     return results[0]
 
 
+def detections_to_array(detections: Results | None) -> np.ndarray:
+    """Turn detections into an (N, 6) array of (x0, y0, x1, y1, class, confidence)."""
+    if detections is None:
+        return np.zeros((0, 6), dtype=np.float32)
+
+    boxes = detections.boxes
+    return np.column_stack([
+        boxes.xyxy.cpu().numpy().reshape(-1, 4),
+        boxes.cls.cpu().numpy(),
+        boxes.conf.cpu().numpy(),
+    ]).astype(np.float32)
+
+
 def get_depth(model: Callable, original_image: np.ndarray, tr_image: np.ndarray) -> np.ndarray:
     """Get the model output and scale it using interpolation."""
+    import torch
+
     with torch.no_grad():
         prediction = model(tr_image)
 
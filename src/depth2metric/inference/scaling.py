@@ -0,0 +1,189 @@
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import numpy as np
+
+from depth2metric.common.settings import get_settings
+from depth2metric.common.utils import get_logger
+
+logger = get_logger(__name__)
+settings = get_settings()
+
+# In order of preference when choosing the scale
+SCENE_PRIORS = "scene priors"
+GROUND_PLANE = "ground plane detection"
+IMAGE_BOTTOM = "bottom image as ground"
+FALLBACK = "fallback factor"
+
+
+@dataclass
+class ScaleCandidate:
+    """Scale estimated by one strategy, with its confidence in [0, 1] and run time in seconds."""
+    method: str
+    scale: float | None
+    confidence: float
+    elapsed: float
+
+
+def sample_points(
+    depth_map: np.ndarray,
+    K: dict[str, float],
+    sample_size: int = settings.scaling_sample_size,
+) -> tuple[np.ndarray, int]:
+    """Back-project a strided pixel grid of the depth map. Returns (rows, cols, 3) points and the stride."""
+    h, w = depth_map.shape
+    stride = max(1, int(np.ceil(np.sqrt(h * w / sample_size))))
+
+    V, U = np.mgrid[0:h:stride, 0:w:stride]
+    Z = depth_map[::stride, ::stride]
+    X = (U - K["cx"]) * (Z / K["fx"])
+    Y = (V - K["cy"]) * (Z / K["fy"]) * -1
+
+    return np.stack([X, Y, Z], axis=-1), stride
+
+
+def scale_from_detections(
+    depth_map: np.ndarray,
+    boxes: np.ndarray,
+    K: dict[str, float],
+    conf_threshold: float = 0.5,
+) -> tuple[float | None, float]:
+    """Use an (N, 6) array of detections with size priors to calculate scale. Returns (scale, avg_conf)."""
+    priors = settings.size_priors
+    h, w = depth_map.shape
+
+    cls = boxes[:, 4].astype(np.int64)
+    usable = np.isin(cls, list(priors)) & (boxes[:, 5] >= conf_threshold)
+    boxes, cls = boxes[usable], cls[usable]
+
+    # Mid-top and mid-bottom pixels of every box
+    x_c = np.clip(((boxes[:, 0] + boxes[:, 2]) / 2).astype(np.int64), 0, w - 1)
+    y_top = np.clip(boxes[:, 1].astype(np.int64), 0, h - 1)
+    y_bottom = np.clip(boxes[:, 3].astype(np.int64), 0, h - 1)
+
+    # Distance of the vertical only
+    Y_top = (y_top - K["cy"]) * depth_map[y_top, x_c] / K["fy"]
+    Y_bottom = (y_bottom - K["cy"]) * depth_map[y_bottom, x_c] / K["fy"]
+    h_rel = np.abs(Y_bottom - Y_top)
+
+    heights = np.array([priors[c][1] for c in cls], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scales = heights / h_rel
+
+    valid = np.isfinite(scales) & (scales > 0)
+    if not valid.any():
+        logger.debug("Found no usable detections.")
+        return None, 0.0
+
+    for c, conf in zip(cls[valid], boxes[valid, 5]):
+        logger.debug(f"Using a detected {priors[c][0]!r} with confidence {conf:.3f} for scale.")
+
+    return float(np.median(scales[valid])), float(boxes[valid, 5].mean())
+
+
+def scale_from_image_bottom(
+    points: np.ndarray,
+    bottom_factor: float = 0.05,
+    camera_height: float = settings.assumed_camera_height,
+) -> tuple[float | None, float]:
+    """Use the bottom rows of the sampled points (assumed ground) and camera height to calculate scale.
+
+    The confidence is the share of bottom points within 10% of their median distance.
+    """
+    rows = max(1, int(np.ceil(bottom_factor * points.shape[0])))
+    bottom = points[-rows:].reshape(-1, 3)
+
+    distances = np.linalg.norm(bottom, axis=1)
+    median = np.median(distances)
+    median_point = bottom[np.abs(median - distances).argmin()]
+
+    # The vertical leg of the camera to ground point triangle
+    ver = abs(median_point[1])
+    if not np.isfinite(ver) or ver == 0:
+        return None, 0.0
+
+    confidence = float(np.mean(np.abs(distances - median) <= 0.1 * median))
+    return float(camera_height / ver), confidence
+
+
+def scale_from_ground_plane(
+    points: np.ndarray,
+    camera_height: float = settings.assumed_camera_height,
+) -> tuple[float | None, float]:
+    """Use a segmented horizontal plane (assumed ground) of the sampled points and camera height to calculate scale.
+
+    The confidence is the inlier share of the candidate ground points, weighted by how
+    horizontal the plane is.
+    """
+    import open3d as o3d
+
+    points = points.reshape(-1, 3)
+
+    # Keep only points that are likely to be ground, below the camera and not too far away
+    mask = (points[:, 1] < 0) & (np.linalg.norm(points, axis=1) < 5000)
+    if np.sum(mask) < settings.ransac_n:
+        logger.debug("Not enough points after filtering for ground plane detection.")
+        return None, 0.0
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points[mask])
+
+    try:
+        [a, b, c, d], inliers = pcd.segment_plane(
+            distance_threshold=settings.ransac_distance_threshold,
+            ransac_n=settings.ransac_n,
+            num_iterations=settings.ransac_iterations,
+        )
+    except Exception as e:
+        logger.debug(f"RANSAC plane segmentation failed: {e}")
+        return None, 0.0
+
+    plane = np.array([a, b, c])
+    normal = np.linalg.norm(plane)
+
+    units = plane / normal
+    # Check if the plane is horizontal enough (aligned with Y axis)
+    if abs(units[1]) < settings.ground_vertical_threshold:
+        logger.debug("The detected plane isn't horizontal enough.")
+        return None, 0.0
+
+    height_to_origin = abs(d) / normal
+    confidence = len(inliers) / np.sum(mask) * abs(units[1])
+
+    return float(camera_height / height_to_origin), float(confidence)
+
+
+def timed_candidate(method: str, func: Callable, *args) -> ScaleCandidate:
+    start_time = time.perf_counter()
+    scale, confidence = func(*args)
+    return ScaleCandidate(method, scale, confidence, time.perf_counter() - start_time)
+
+
+def estimate_scale(
+    depth_map: np.ndarray,
+    boxes: np.ndarray,
+    K: dict[str, float],
+) -> list[ScaleCandidate]:
+    """Run every scaling strategy and return their candidates in order of preference.
+
+    The ground plane and image bottom strategies share one subsample of the cloud, so
+    the stage costs about as much as the RANSAC fit alone.
+    """
+    points, stride = sample_points(depth_map, K)
+    logger.debug(f"Sampled {points.shape[0] * points.shape[1]} points with stride {stride} for scaling.")
+
+    return [
+        timed_candidate(SCENE_PRIORS, scale_from_detections, depth_map, boxes, K),
+        timed_candidate(GROUND_PLANE, scale_from_ground_plane, points),
+        timed_candidate(IMAGE_BOTTOM, scale_from_image_bottom, points),
+    ]
+
+
+def select_scale(candidates: list[ScaleCandidate]) -> tuple[float, str]:
+    """Pick the first usable candidate, capped at the fallback factor. Returns (scale, method)."""
+    scale, method = next(((c.scale, c.method) for c in candidates if c.scale is not None), (None, FALLBACK))
+
+    if scale is None or scale > settings.fallback_scale_factor:
+        return settings.fallback_scale_factor, FALLBACK
+    return scale, method
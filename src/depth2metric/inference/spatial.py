@@ -0,0 +1,154 @@
+import time
+
+import numpy as np
+
+from depth2metric.common.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class SpatialIndex:
+    """KD-tree over a downsampled point cloud for picking, neighbour queries and snapping."""
+
+    def __init__(self, points: np.ndarray):
+        from scipy.spatial import cKDTree
+
+        start_time = time.perf_counter()
+
+        self.points = np.ascontiguousarray(points, dtype=np.float64)
+        self.tree = cKDTree(self.points, balanced_tree=False, compact_nodes=False)
+        self.bounds = (self.points.min(axis=0), self.points.max(axis=0))
+
+        self.build_time = time.perf_counter() - start_time
+        logger.debug(
+            f"Built spatial index over {len(self.points)} points in {self.build_time * 1000:.1f}ms "
+            f"(~{self.nbytes / 1024:.0f} KiB)."
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the index (points and tree permutation)."""
+        return self.points.nbytes + self.tree.indices.nbytes
+
+    def knn(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Distances and indices of the k nearest points of each query, shaped (Q, k)."""
+        k = min(k, len(self.points))
+        distances, indices = self.tree.query(queries, k=k)
+        return distances.reshape(len(queries), k), indices.reshape(len(queries), k)
+
+    def radius(self, queries: np.ndarray, radius: float, max_results: int) -> list[list[int]]:
+        """Indices of the points within a radius of each query, nearest first.
+
+        Only the max_results nearest points are looked up, so a large radius doesn't
+        gather the whole cloud.
+        """
+        k = min(max_results, len(self.points))
+        distances, indices = self.tree.query(queries, k=k, distance_upper_bound=radius)
+        distances, indices = distances.reshape(len(queries), k), indices.reshape(len(queries), k)
+
+        # Missing neighbours have an infinite distance
+        return [row[np.isfinite(d)].tolist() for d, row in zip(distances, indices)]
+
+    def ray_pick(
+        self,
+        origins: np.ndarray,
+        directions: np.ndarray,
+        radius: float,
+        max_steps: int = 64,
+        chunk: int = 16,
+    ) -> np.ndarray:
+        """Index of the first point each ray passes within radius of, or -1 for a miss.
+
+        Each ray is cut into at most max_steps segments between its entry and exit of the
+        cloud bounds grown by radius, and a ball query per segment collects the candidates of the cylinder
+        around it. Segments are visited in chunks, and rays stop at their first hit.
+        """
+        directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+        t_near, t_far = self.clip_rays(origins, directions, radius)
+
+        extent = (t_far - t_near).max(initial=0.0)
+        spacing = max(2 * radius, extent / max_steps)
+        steps = max(1, int(np.ceil(extent / spacing)))
+        ball_radius = np.hypot(spacing / 2, radius)
+
+        picked = np.full(len(origins), -1, dtype=np.int64)
+        active = np.flatnonzero(t_far >= t_near)
+
+        for start in range(0, steps, chunk):
+            if len(active) == 0:
+                break
+
+            # Segment centers of the active rays, each ball encloses its piece of the cylinder
+            segments = np.arange(start, min(start + chunk, steps)) + 0.5
+            t = t_near[active, None] + segments[None, :] * spacing
+            centers = origins[active, None, :] + t[..., None] * directions[active, None, :]
+            balls = self.tree.query_ball_point(centers.reshape(-1, 3), ball_radius)
+
+            counts = np.fromiter((len(b) for b in balls), dtype=np.int64, count=len(balls))
+            if counts.sum() > 0:
+                candidates = np.concatenate([b for b in balls if b]).astype(np.int64)
+                rays = active[np.repeat(np.arange(len(balls)) // len(segments), counts)]
+
+                # Distance along and away from the ray of every candidate
+                offsets = self.points[candidates] - origins[rays]
+                along = np.einsum("ni,ni->n", offsets, directions[rays])
+                away = np.linalg.norm(offsets - along[:, None] * directions[rays], axis=1)
+
+                hits = (away <= radius) & (along >= t_near[rays]) & (along <= t_far[rays])
+                rays, candidates, along = rays[hits], candidates[hits], along[hits]
+
+                # Nearest hit along each ray
+                order = np.lexsort((along, rays))
+                rays, first = np.unique(rays[order], return_index=True)
+                picked[rays] = candidates[order][first]
+
+            # Rays ending in this chunk are done too
+            end = t_near[active] + (start + len(segments)) * spacing
+            active = active[(picked[active] < 0) & (end < t_far[active])]
+
+        return picked
+
+    def clip_rays(
+        self,
+        origins: np.ndarray,
+        directions: np.ndarray,
+        margin: float = 0.0,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Entry and exit distances of each ray through the cloud bounding box grown by margin (slab method)."""
+        low, high = self.bounds[0] - margin, self.bounds[1] + margin
+        parallel = directions == 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = np.where(parallel, -np.inf, (low - origins) / directions)
+            t2 = np.where(parallel, np.inf, (high - origins) / directions)
+
+        t_near = np.maximum(np.minimum(t1, t2).max(axis=1), 0.0)
+        t_far = np.maximum(t1, t2).min(axis=1)
+
+        # Rays missing the box (or parallel to a slab they're outside of) get an empty interval
+        outside = parallel & ((origins < low) | (origins > high))
+        misses = (t_far < t_near) | outside.any(axis=1)
+        t_near[misses], t_far[misses] = 0.0, -1.0
+        return t_near, t_far
+
+    def fit_planes(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Fit a local plane to the k neighbours of each query for surface snapping.
+
+        Returns the queries projected on their planes, the unit plane normals, and the RMS
+        distance of the neighbours to the planes.
+        """
+        _, indices = self.knn(queries, k)
+        neighbours = self.points[indices]
+
+        centers = neighbours.mean(axis=1)
+        centered = neighbours - centers[:, None, :]
+        covariance = np.einsum("qki,qkj->qij", centered, centered) / indices.shape[1]
+
+        # Eigenvalues are sorted ascending, the normal is the direction of least variance
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        normals = eigenvectors[:, :, 0]
+        rms = np.sqrt(np.maximum(eigenvalues[:, 0], 0.0))
+
+        offsets = np.einsum("qi,qi->q", queries - centers, normals)
+        snapped = queries - offsets[:, None] * normals
+
+        return snapped, normals, rms
@@ -0,0 +1,64 @@
+# Deterministic stand-ins for MiDaS and YOLO, used to profile the service offline
+
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+STUB_WORKING_SIZE = 384
+
+
+class StubTransform:
+    """Mimics the MiDaS transforms by resizing to the working resolution and batching."""
+
+    def __call__(self, image: np.ndarray):
+        import torch
+
+        resized = cv2.resize(image, (STUB_WORKING_SIZE, STUB_WORKING_SIZE), interpolation=cv2.INTER_AREA)
+        return torch.from_numpy(resized).permute(2, 0, 1).unsqueeze(0).float() / 255.0
+
+
+class StubMidas:
+    """Returns a smooth, image-dependent depth map after a fixed delay."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def __call__(self, tr_image):
+        import torch
+
+        start_time = time.perf_counter()
+        _, _, h, w = tr_image.shape
+
+        # Depth grows towards the top of the image like a floor seen from standing height,
+        # with some texture from the image brightness, in the value range of DPT outputs
+        rows = torch.linspace(100.0, 1500.0, h).flip(0)[:, None].expand(h, w)
+        prediction = rows + 50.0 * tr_image[0].mean(dim=0)
+
+        time.sleep(max(0.0, self.latency - (time.perf_counter() - start_time)))
+        return prediction.unsqueeze(0)
+
+
+class StubYolo:
+    """Detects a single chair in the lower middle of about half of the images, chosen by intensity."""
+
+    names = {56: "chair"}
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def __call__(self, image: np.ndarray):
+        import torch
+
+        start_time = time.perf_counter()
+        h, w = image.shape[:2]
+
+        if int(image.mean() * 100) % 2 == 0:
+            xyxy = torch.tensor([[w * 0.4, h * 0.5, w * 0.6, h * 0.8]])
+            cls, conf = torch.tensor([56.0]), torch.tensor([0.9])
+        else:
+            xyxy, cls, conf = torch.zeros((0, 4)), torch.zeros(0), torch.zeros(0)
+
+        time.sleep(max(0.0, self.latency - (time.perf_counter() - start_time)))
+        return [SimpleNamespace(boxes=SimpleNamespace(xyxy=xyxy, cls=cls, conf=conf))]
@@ -0,0 +1,44 @@
+# Debugging helpers, never imported by the server
+
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import open3d as o3d
+
+
+def show_results(
+    image: np.ndarray,
+    output: np.ndarray,
+    d_image: np.ndarray | None = None
+) -> None:
+    axes_count = 3 if d_image is not None else 2
+    _, axes = plt.subplots(1, axes_count, figsize=(10, 4))
+
+    axes.flat[0].imshow(image)
+    axes.flat[0].set_title("Original")
+
+    axes.flat[1].imshow(output, cmap="inferno")
+    axes.flat[1].set_title("Predicted Depth")
+
+    if d_image is not None:
+        # Depth read unchanged is single channel, older 8-bit reads repeat it over RGB
+        d_image = d_image if d_image.ndim == 2 else d_image[..., 0]
+        axes.flat[2].imshow(~d_image, cmap="inferno")
+        axes.flat[2].set_title("True Depth")
+
+    plt.tight_layout()
+    plt.show()
+
+
+def visualize_pcd(
+    pcd: o3d.geometry.PointCloud,
+    colors: np.ndarray | None = None
+) -> None:
+    if colors is not None:
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+
+    if os.environ["XDG_SESSION_TYPE"] == "wayland":
+        os.environ["XDG_SESSION_TYPE"] = "x11"
+
+    o3d.visualization.draw_geometries([pcd]) # type: ignore
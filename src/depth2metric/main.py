@@ -1,20 +1,52 @@
 import asyncio
 import gzip
+import json
+import threading
+import time
 from contextlib import asynccontextmanager
 from functools import partial
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException, Request, Response, UploadFile
+import numpy as np
+from fastapi import FastAPI, Form, HTTPException, Request, Response, UploadFile
 from fastapi.middleware import cors, trustedhost
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
-
-from depth2metric.common.metrics import MANUAL_CALIBRATION_TOTAL, PAYLOAD_SIZE_BYTES
+from pydantic import BaseModel
+
+from depth2metric.common.cancellation import CancellationToken, RequestCancelled
+from depth2metric.common.metrics import (
+    CANCELLED_REQUESTS_TOTAL,
+    EXECUTOR_QUEUE_LENGTH,
+    IN_FLIGHT_REQUESTS,
+    MANUAL_CALIBRATION_TOTAL,
+    PAYLOAD_SIZE_BYTES,
+    SPATIAL_QUERY_LATENCY,
+    generate_metrics,
+    mark_process_dead,
+    update_process_metrics,
+)
 from depth2metric.common.settings import get_settings
 from depth2metric.common.utils import get_logger
+from depth2metric.inference.geometry import (
+    clip_roi,
+    distances_between_pixels,
+    get_roi_from_detections,
+)
 from depth2metric.inference.models import get_midas, get_yolo
-from depth2metric.pipeline import depth_pcd, pack_pointcloud, precompute_samples
+from depth2metric.inference.spatial import SpatialIndex
+from depth2metric.pipeline import (
+    build_index,
+    build_pcd,
+    encode_depth,
+    index_from_depth,
+    load_samples_metadata,
+    pack_pointcloud,
+    precompute_samples,
+    resolve_target_points,
+    scaled_depth,
+)
+from depth2metric.results import AnalysisResult, ResultStore
 
 logger = get_logger(__name__)
 settings = get_settings()
@@ -23,22 +55,103 @@ SAMPLES_DIR = Path(settings.samples_dir)
 PRECOMP_DIR = Path(settings.precomputed_dir)
 
 
+async def update_metrics_periodically():
+    while True:
+        update_process_metrics()
+        await asyncio.sleep(settings.metrics_update_interval)
+
+
+async def run_in_executor(func, *args, token: CancellationToken | None = None):
+    """Run a blocking function in the default executor, tracking jobs waiting to start.
+
+    If a token is given, the job is dropped when it starts after the request was cancelled
+    or its deadline passed.
+    """
+    # Whoever leaves the queue first, the starting job or the awaiting request giving up,
+    # takes the job off the queue length
+    dequeued = False
+    lock = threading.Lock()
+
+    def dequeue() -> bool:
+        nonlocal dequeued
+        with lock:
+            if dequeued:
+                return False
+            dequeued = True
+        EXECUTOR_QUEUE_LENGTH.dec()
+        return True
+
+    def job():
+        # Nobody waits for the result anymore
+        if not dequeue():
+            return None
+        if token is not None:
+            token.check("queued")
+        return func(*args)
+
+    EXECUTOR_QUEUE_LENGTH.inc()
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(None, job)
+    finally:
+        dequeue()
+
+
+async def watch_disconnect(request: Request, token: CancellationToken):
+    while not token.event.is_set():
+        if await request.is_disconnected():
+            token.cancel("disconnected")
+            return
+        await asyncio.sleep(settings.disconnect_poll_interval)
+
+
+@asynccontextmanager
+async def request_token(request: Request):
+    """Give the request a deadline and cancel its token when the client disconnects."""
+    token = CancellationToken(settings.request_timeout)
+    watcher = asyncio.create_task(watch_disconnect(request, token))
+    try:
+        yield token
+    finally:
+        watcher.cancel()
+
+
+def cancellation_error(e: RequestCancelled) -> HTTPException:
+    CANCELLED_REQUESTS_TOTAL.labels(reason=e.reason, stage=e.stage).inc()
+    logger.info(f"Stopped analysis: {e}")
+
+    if e.reason == "expired":
+        return HTTPException(504, "The analysis took too long.")
+    return HTTPException(499, "Client closed request.")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Load models once
     midas, transforms = get_midas()
     yolo = get_yolo()
 
-    # Precompute samples (synchronous during startup is fine)
-    samples_metadata = precompute_samples(midas, transforms, yolo)
+    # Precompute samples (synchronous during startup is fine). With several workers, they're
+    # precomputed once before starting them, and every worker only reads them
+    results = ResultStore(settings.result_cache_size, settings.result_cache_bytes, settings.results_dir)
+    if settings.precompute_on_startup:
+        samples_metadata = precompute_samples(midas, transforms, yolo, results)
+    else:
+        samples_metadata = load_samples_metadata()
+
+    metrics_task = asyncio.create_task(update_metrics_periodically())
 
     yield {
         "yolo": yolo,
         "midas": midas,
         "transforms": transforms,
         "samples_metadata": samples_metadata,
+        "results": results,
     }
 
+    metrics_task.cancel()
+    mark_process_dead()
+
 
 app = FastAPI(
     title="Depth2Metric",
@@ -76,6 +189,23 @@ app.mount("/static", static_files, "static")
 jinja = Jinja2Templates("static/")
 
 
+class InFlightRequestsMiddleware:
+    """Plain ASGI middleware, so client disconnects still reach the endpoints."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        with IN_FLIGHT_REQUESTS.track_inprogress():
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(InFlightRequestsMiddleware)
+
+
 @app.get("/health")
 async def health_check():
     return None
@@ -88,7 +218,8 @@ async def ping():
 
 @app.get("/metrics")
 async def metrics():
-    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    content, content_type = generate_metrics()
+    return Response(content=content, media_type=content_type)
 
 
 @app.post("/telemetry/calibrate")
@@ -109,12 +240,67 @@ async def root(request: Request):
     )
 
 
+OUTPUTS = ("points", "depth")
+
+
+def validate_output(output: str, depth_width: int | None) -> None:
+    if output not in OUTPUTS:
+        raise HTTPException(400, f"Output must be one of {', '.join(OUTPUTS)}.")
+
+    if depth_width is not None and depth_width <= 0:
+        raise HTTPException(400, "Depth width must be positive.")
+
+
+async def depth_response(
+    result: AnalysisResult,
+    roi: tuple[int, int, int, int] | None,
+    width: int | None,
+    result_id: str | None,
+    token: CancellationToken | None = None,
+) -> Response:
+    """Encode and compress the metric depth of a result instead of a point cloud."""
+    packed_data = await run_in_executor(encode_depth, result, roi, width, result_id, token=token)
+    PAYLOAD_SIZE_BYTES.labels(type="uncompressed").observe(len(packed_data))
+
+    buffer = await run_in_executor(gzip.compress, packed_data, token=token)
+    PAYLOAD_SIZE_BYTES.labels(type="compressed").observe(len(buffer))
+
+    headers = {
+        "Content-Encoding": "gzip",
+        "X-Scaling-Factor": str(result.scale_factor),
+        "X-Scaling-Method": result.method,
+        "X-ROI": ",".join(map(str, roi)) if roi is not None else "none",
+        "X-Output": "depth",
+    }
+    if result_id is not None:
+        headers["X-Result-Id"] = result_id
+
+    return Response(buffer, media_type="application/octet-stream", headers=headers)
+
+
+@app.get("/samples")
+async def list_samples(request: Request):
+    return sorted(request.state.samples_metadata)
+
+
 @app.post("/analyze/{filename}")
-async def process_sample(request: Request, filename: str):
+async def process_sample(
+    request: Request,
+    filename: str,
+    output: str = Form("points"),
+    depth_width: int | None = Form(None),
+):
     metadata = request.state.samples_metadata.get(filename)
     if not metadata:
         raise HTTPException(404, "Sample metadata not found")
 
+    validate_output(output, depth_width)
+    if output == "depth":
+        result = await run_in_executor(request.state.results.get, filename)
+        if result is None:
+            raise HTTPException(404, "Sample not found")
+        return await depth_response(result, None, depth_width, filename)
+
     filename_bytes = filename.split(".")[0] + ".bytes"
     path = PRECOMP_DIR / filename_bytes
 
@@ -123,8 +309,7 @@ async def process_sample(request: Request, filename: str):
         raise HTTPException(404, "Sample not found")
 
     # Use a thread for I/O
-    loop = asyncio.get_event_loop()
-    buffer = await loop.run_in_executor(None, path.read_bytes)
+    buffer = await run_in_executor(path.read_bytes)
 
     # Record payload size (it's already compressed in precomputed samples)
     PAYLOAD_SIZE_BYTES.labels(type="compressed").observe(len(buffer))
@@ -139,8 +324,7 @@ async def process_sample(request: Request, filename: str):
     )
 
 
-@app.post("/analyze")
-async def analyze(request: Request, file: UploadFile):
+def validate_image(file: UploadFile) -> None:
     mimes = ["image/png", "image/jpeg"]
     if file.size is None or file.content_type not in mimes:
         raise HTTPException(
@@ -154,29 +338,155 @@ async def analyze(request: Request, file: UploadFile):
             detail="Image file is too big. Image size must be smaller than 8 MB."
         )
 
-    loop = asyncio.get_event_loop()
+
+async def analyze_image(request: Request, file: UploadFile, token: CancellationToken):
+    """Run depth inference and scaling on an uploaded image."""
+    image, result = await run_in_executor(
+        partial(
+            scaled_depth,
+            file.file,
+            request.state.midas,
+            request.state.transforms,
+            request.state.yolo,
+            token,
+        ),
+        token=token,
+    )
+    return image, result
+
+
+def parse_roi(roi: str) -> tuple[int, int, int, int]:
+    try:
+        x0, y0, x1, y1 = (int(v) for v in roi.split(","))
+    except ValueError:
+        raise HTTPException(400, "ROI must be given as 'x0,y0,x1,y1' pixel coordinates.")
+    return x0, y0, x1, y1
+
+
+def parse_pairs(pairs: str) -> np.ndarray:
+    """Turn a JSON list of [u1, v1, u2, v2] pixel pairs into an (N, 4) int array."""
+    message = "Pairs must be a JSON list of [u1, v1, u2, v2] pixel coordinates."
+    try:
+        values = json.loads(pairs)
+    except ValueError:
+        raise HTTPException(400, message)
+
+    if not isinstance(values, list) or len(values) == 0:
+        raise HTTPException(400, message)
+    if len(values) > settings.max_measure_pairs:
+        raise HTTPException(400, f"At most {settings.max_measure_pairs} pairs can be measured at once.")
+
+    # Fractional coordinates would be silently truncated by the cast
+    for pair in values:
+        if not isinstance(pair, list) or len(pair) != 4:
+            raise HTTPException(400, message)
+        for c in pair:
+            if isinstance(c, bool) or not (isinstance(c, int) or (isinstance(c, float) and c.is_integer())):
+                raise HTTPException(400, message)
+
+    try:
+        return np.asarray(values, dtype=np.int64)
+    except OverflowError:
+        raise HTTPException(400, message)
+
+
+def resolve_class(yolo, focus: str) -> int:
+    """Turn a class id or name of the detection model into a class id."""
+    names = {name.lower().replace(" ", "_"): cls for cls, name in yolo.names.items()}
+    focus = focus.strip().lower().replace(" ", "_")
+
+    if focus.isdigit() and int(focus) in yolo.names:
+        return int(focus)
+    if focus in names:
+        return names[focus]
+    raise HTTPException(400, f"Unknown object class {focus!r}.")
+
+
+@app.post("/analyze")
+async def analyze(
+    request: Request,
+    file: UploadFile,
+    roi: str | None = Form(None),
+    focus: str | None = Form(None),
+    voxel_size: float | None = Form(None),
+    target_points: int | None = Form(None),
+    target_bytes: int | None = Form(None),
+    output: str = Form("points"),
+    depth_width: int | None = Form(None),
+):
+    """Analyze an image, optionally only building the cloud for a region of interest.
+
+    The region is either an 'x0,y0,x1,y1' rectangle or the most confident detection of the
+    `focus` class. Depth and scale always use the whole image.
+
+    Instead of a voxel size, a point or payload budget can be given, and the finest
+    voxel size that fits it is used. An explicit voxel size also overrides the server-wide
+    budget.
+
+    With `output=depth`, the scaled depth map is sent at a working resolution instead of
+    a point cloud, and the client back-projects it.
+    """
+    validate_image(file)
+    validate_output(output, depth_width)
+
+    roi_rect = parse_roi(roi) if roi is not None else None
+    focus_cls = resolve_class(request.state.yolo, focus) if focus is not None else None
+
+    if voxel_size is not None:
+        if roi_rect is None and focus_cls is None:
+            raise HTTPException(400, "A custom voxel size requires a region of interest.")
+        if voxel_size < settings.min_voxel_size:
+            raise HTTPException(400, f"Voxel size must be at least {settings.min_voxel_size}.")
+
+    if (target_points is not None and target_points <= 0) or (target_bytes is not None and target_bytes <= 0):
+        raise HTTPException(400, "Point and byte budgets must be positive.")
+    if voxel_size is not None and (target_points is not None or target_bytes is not None):
+        raise HTTPException(400, "Either a voxel size or a budget can be given, not both.")
+    target = resolve_target_points(target_points, target_bytes)
+
+    if output == "depth" and (voxel_size is not None or target_points is not None or target_bytes is not None):
+        raise HTTPException(400, "Voxel sizes and budgets only apply to point clouds.")
 
     # Run heavy compute in a separate thread to keep the event loop free
     try:
-        # Offload depth processing
-        pcd, scale_factor, scaling_method = await loop.run_in_executor(
-            None,
-            partial(
-                depth_pcd,
-                file.file,
-                request.state.midas,
-                request.state.transforms,
-                request.state.yolo,
+        async with request_token(request) as token:
+            # Offload depth processing
+            image, analysis = await analyze_image(request, file, token)
+
+            height, width = analysis.depth_map.shape
+            if roi_rect is not None:
+                roi_rect = clip_roi(roi_rect, width, height)
+            elif focus_cls is not None:
+                roi_rect = get_roi_from_detections(analysis.boxes, focus_cls, width, height)
+
+            # The client back-projects the depth, so projection and packing are skipped
+            if output == "depth":
+                result_id = await run_in_executor(request.state.results.add, analysis, token=token)
+                return await depth_response(analysis, roi_rect, depth_width, result_id, token)
+
+            # Without a usable region, the whole image is used at the default resolution
+            if roi_rect is None:
+                voxel_size = None
+
+            pcd, voxel_size = await run_in_executor(
+                build_pcd, image, analysis, roi_rect, voxel_size, target, token, token=token,
             )
-        )
 
-        # Offload packing and compression
-        packed_data = await loop.run_in_executor(None, pack_pointcloud, pcd)
-        PAYLOAD_SIZE_BYTES.labels(type="uncompressed").observe(len(packed_data))
+            # Offload packing and spatial indexing, then compression
+            packed_data, analysis.index = await asyncio.gather(
+                run_in_executor(pack_pointcloud, pcd, token=token),
+                run_in_executor(build_index, pcd, token=token),
+            )
+            PAYLOAD_SIZE_BYTES.labels(type="uncompressed").observe(len(packed_data))
+
+            # Only publish the result once it can answer spatial queries
+            result_id = await run_in_executor(request.state.results.add, analysis, token=token)
 
-        result = await loop.run_in_executor(None, gzip.compress, packed_data)
-        PAYLOAD_SIZE_BYTES.labels(type="compressed").observe(len(result))
+            result = await run_in_executor(gzip.compress, packed_data, token=token)
+            PAYLOAD_SIZE_BYTES.labels(type="compressed").observe(len(result))
 
+    except RequestCancelled as e:
+        raise cancellation_error(e)
     except Exception as e:
         logger.exception("Error during image analysis")
         raise HTTPException(status_code=500, detail=str(e))
@@ -188,7 +498,187 @@ async def analyze(request: Request, file: UploadFile):
         media_type="application/octet-stream",
         headers={
             "Content-Encoding": "gzip",
-            "X-Scaling-Factor": str(scale_factor),
-            "X-Scaling-Method": scaling_method,
+            "X-Scaling-Factor": str(analysis.scale_factor),
+            "X-Scaling-Method": analysis.method,
+            "X-Result-Id": result_id,
+            "X-ROI": ",".join(map(str, roi_rect)) if roi_rect is not None else "none",
+            "X-Voxel-Size": f"{voxel_size:.4g}",
         },
     )
+
+
+@app.post("/measure")
+async def measure(
+    request: Request,
+    pairs: str = Form(),
+    result_id: str | None = Form(None),
+    file: UploadFile | None = None,
+):
+    """Measure a batch of (u1, v1, u2, v2) pixel pairs on an image or a stored result."""
+    pixel_pairs = parse_pairs(pairs)
+
+    if file is not None:
+        validate_image(file)
+        try:
+            async with request_token(request) as token:
+                _, result = await analyze_image(request, file, token)
+                result_id = await run_in_executor(request.state.results.add, result, token=token)
+        except RequestCancelled as e:
+            raise cancellation_error(e)
+        except Exception as e:
+            logger.exception("Error during image analysis")
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            await file.close()
+    elif result_id is not None:
+        result = await run_in_executor(request.state.results.get, result_id)
+        if result is None:
+            raise HTTPException(404, "Result not found")
+    else:
+        raise HTTPException(400, "Either an image file or a result id is required.")
+
+    h, w = result.depth_map.shape
+    U, V = pixel_pairs[:, [0, 2]], pixel_pairs[:, [1, 3]]
+    if (U < 0).any() or (U >= w).any() or (V < 0).any() or (V >= h).any():
+        raise HTTPException(400, f"Pixel coordinates must be within the {w}x{h} image.")
+
+    distances = distances_between_pixels(pixel_pairs, result.depth_map, result.K)
+
+    return {
+        "result_id": result_id,
+        "scale_factor": result.scale_factor,
+        "distances": np.round(distances, 2).tolist(),
+    }
+
+
+class PointsQuery(BaseModel):
+    points: list[tuple[float, float, float]]
+
+
+class KnnQuery(PointsQuery):
+    k: int = 8
+
+
+class RadiusQuery(PointsQuery):
+    radius: float
+    max_results: int = 64
+
+
+class PlanesQuery(PointsQuery):
+    k: int = 16
+
+
+class PickQuery(BaseModel):
+    origins: list[tuple[float, float, float]]
+    directions: list[tuple[float, float, float]]
+    radius: float | None = None
+
+
+INDEX_LOCK = asyncio.Lock()
+
+
+async def get_index(request: Request, result_id: str, queries: int, k: int = 1) -> SpatialIndex:
+    if queries == 0 or queries > settings.max_spatial_queries:
+        raise HTTPException(400, f"Between 1 and {settings.max_spatial_queries} queries are allowed at once.")
+
+    if k < 1 or k > settings.max_spatial_neighbours:
+        raise HTTPException(400, f"Between 1 and {settings.max_spatial_neighbours} neighbours are allowed.")
+
+    # May load the result from the shared directory
+    result = await run_in_executor(request.state.results.get, result_id)
+    if result is None:
+        raise HTTPException(404, "Result not found")
+
+    # Results sent as depth maps are indexed on their first query
+    if result.index is None:
+        async with INDEX_LOCK:
+            if result.index is None:
+                result.index = await run_in_executor(index_from_depth, result)
+
+    return result.index
+
+
+async def run_spatial_query(query: str, func, *args):
+    """Run a spatial index query in the executor, returning its result and duration in ms."""
+    def timed():
+        start_time = time.perf_counter()
+        output = func(*args)
+        elapsed = time.perf_counter() - start_time
+        SPATIAL_QUERY_LATENCY.labels(query=query).observe(elapsed)
+        return output, elapsed * 1000
+
+    return await run_in_executor(timed)
+
+
+@app.post("/results/{result_id}/pick")
+async def pick_points(request: Request, result_id: str, body: PickQuery):
+    """Pick the first cloud point hit by each ray, in the coordinates of the packed cloud."""
+    if len(body.origins) != len(body.directions):
+        raise HTTPException(400, "Origins and directions must have the same length.")
+
+    index = await get_index(request, result_id, len(body.origins))
+
+    directions = np.asarray(body.directions, dtype=np.float64)
+    if (np.linalg.norm(directions, axis=1) == 0).any():
+        raise HTTPException(400, "Ray directions must be non-zero.")
+
+    radius = body.radius if body.radius is not None else settings.voxel_size
+    if radius < settings.min_voxel_size:
+        raise HTTPException(400, f"Pick radius must be at least {settings.min_voxel_size}.")
+
+    indices, elapsed = await run_spatial_query(
+        "pick", index.ray_pick, np.asarray(body.origins, dtype=np.float64), directions, radius,
+    )
+
+    return {
+        "indices": indices.tolist(),
+        "points": [index.points[i].tolist() if i >= 0 else None for i in indices],
+        "query_ms": elapsed,
+    }
+
+
+@app.post("/results/{result_id}/knn")
+async def nearest_points(request: Request, result_id: str, body: KnnQuery):
+    index = await get_index(request, result_id, len(body.points), body.k)
+
+    (distances, indices), elapsed = await run_spatial_query(
+        "knn", index.knn, np.asarray(body.points, dtype=np.float64), body.k,
+    )
+
+    return {
+        "indices": indices.tolist(),
+        "distances": np.round(distances, 3).tolist(),
+        "query_ms": elapsed,
+    }
+
+
+@app.post("/results/{result_id}/radius")
+async def radius_points(request: Request, result_id: str, body: RadiusQuery):
+    index = await get_index(request, result_id, len(body.points), body.max_results)
+    if body.radius <= 0:
+        raise HTTPException(400, "Radius must be positive.")
+
+    indices, elapsed = await run_spatial_query(
+        "radius", index.radius, np.asarray(body.points, dtype=np.float64), body.radius, body.max_results,
+    )
+
+    return {"indices": indices, "query_ms": elapsed}
+
+
+@app.post("/results/{result_id}/planes")
+async def fit_planes(request: Request, result_id: str, body: PlanesQuery):
+    """Fit local planes around each point to snap measurements to surfaces."""
+    index = await get_index(request, result_id, len(body.points), body.k)
+    if body.k < 3:
+        raise HTTPException(400, "At least 3 neighbours are needed to fit a plane.")
+
+    (snapped, normals, rms), elapsed = await run_spatial_query(
+        "planes", index.fit_planes, np.asarray(body.points, dtype=np.float64), body.k,
+    )
+
+    return {
+        "points": np.round(snapped, 3).tolist(),
+        "normals": np.round(normals, 4).tolist(),
+        "rms": np.round(rms, 3).tolist(),
+        "query_ms": elapsed,
+    }
@@ -1,39 +1,53 @@
+from __future__ import annotations
+
 import gzip
+import json
 import os
 import re
 import shutil
 import time
 from collections.abc import Callable
 from pathlib import Path
-from typing import BinaryIO
+from typing import TYPE_CHECKING, BinaryIO
 
 import cv2
 import numpy as np
-import open3d as o3d
-from ultralytics import YOLO  # type: ignore
 
+from depth2metric.common.cancellation import CancellationToken
 from depth2metric.common.metrics import (
     DETECTION_CONFIDENCE,
     INFERENCE_LATENCY,
     SCALING_METHOD_TOTAL,
+    SCALING_STRATEGY_LATENCY,
+    SPATIAL_INDEX_SIZE_BYTES,
 )
 from depth2metric.common.settings import get_settings
 from depth2metric.common.utils import get_logger
-from depth2metric.inference.camera import fallback_intrinsics, intrinsics_from_exif
-from depth2metric.inference.geometry import (
-    get_pcd_points,
-    get_scale_from_detections,
-    get_scale_from_ground_plane,
-    get_scale_from_image_bottom,
+from depth2metric.inference.camera import (
+    crop_intrinsics,
+    fallback_intrinsics,
+    intrinsics_from_exif,
 )
-from depth2metric.inference.models import get_depth_map, get_detections
+from depth2metric.inference.geometry import estimate_voxel_size, get_pcd_points
+from depth2metric.inference.models import detections_to_array, get_depth_map, get_detections
+from depth2metric.inference.scaling import SCENE_PRIORS, estimate_scale, select_scale
+from depth2metric.inference.spatial import SpatialIndex
 from depth2metric.inference.utils import get_image_colors
+from depth2metric.results import AnalysisResult, ResultStore
+
+if TYPE_CHECKING:
+    import open3d as o3d
+    from ultralytics import YOLO  # type: ignore
 
 settings = get_settings()
 logger = get_logger(__name__)
 
 SAMPLES_DIR = Path(settings.samples_dir)
 PRECOMP_DIR = Path(settings.precomputed_dir)
+SAMPLES_METADATA = PRECOMP_DIR / "metadata.json"
+
+# Bytes per packed point, 3 float32 coordinates and 3 uint8 colors
+POINT_SIZE = 15
 
 
 def points_to_pcd(
@@ -41,6 +55,8 @@ def points_to_pcd(
     colors: np.ndarray | None = None,
 ) -> o3d.geometry.PointCloud:
     """Generate a point cloud from points."""
+    import open3d as o3d
+
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(points)
 
@@ -50,13 +66,19 @@ def points_to_pcd(
     return pcd
 
 
-def depth_pcd(
+def scaled_depth(
     image_file: BinaryIO,
     midas: Callable,
     midas_transforms: Callable,
-    yolo: YOLO
-) -> tuple[o3d.geometry.PointCloud, float, str]:
-    """Read image, extract intrinsics, calculate scale, and return downsampled point cloud."""
+    yolo: YOLO,
+    token: CancellationToken | None = None,
+) -> tuple[np.ndarray, AnalysisResult]:
+    """Read image, extract intrinsics, and return the image with its metric depth map.
+
+    The token is checked between stages, so abandoned or expired requests stop early.
+    """
+    token = token or CancellationToken()
+
     image_bytes = np.frombuffer(image_file.read(), dtype=np.uint8)
     image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR_RGB)
 
@@ -71,51 +93,175 @@ def depth_pcd(
         K = fallback_intrinsics(width, height)
 
     # Measure MiDaS Latency
+    token.check("midas")
     start_time = time.perf_counter()
     depth_map = get_depth_map(midas, midas_transforms, image)
     INFERENCE_LATENCY.labels(component="midas").observe(time.perf_counter() - start_time)
 
     # Measure YOLO Latency
+    token.check("yolo")
     start_time = time.perf_counter()
     detections = get_detections(yolo, image)
     INFERENCE_LATENCY.labels(component="yolo").observe(time.perf_counter() - start_time)
 
-    # Measure PCD projection and Scaling logic latency
+    # Measure Scaling logic latency
+    token.check("scaling")
     start_time = time.perf_counter()
-    pcd_points = get_pcd_points(depth_map, K)
-
-    scale_factor, method = None, ""
-    if detections is not None:
-        scale_factor, avg_conf = get_scale_from_detections(depth_map, detections, K)
-        if scale_factor is not None:
-            method = "scene priors"
-            DETECTION_CONFIDENCE.observe(avg_conf)
-
-    if scale_factor is None:
-        scale_factor = get_scale_from_ground_plane(points_to_pcd(pcd_points))
-        method = "ground plane detection"
+    boxes = detections_to_array(detections)
+    candidates = estimate_scale(depth_map, boxes, K)
 
-    if scale_factor is None:
-        scale_factor = get_scale_from_image_bottom(pcd_points)
-        method = "bottom image as ground"
+    for candidate in candidates:
+        SCALING_STRATEGY_LATENCY.labels(method=candidate.method).observe(candidate.elapsed)
+        logger.debug(
+            f"Scale candidate {candidate.method!r}: {candidate.scale} with confidence "
+            f"{candidate.confidence:.3f} in {candidate.elapsed * 1000:.1f}ms."
+        )
 
-    if scale_factor > settings.fallback_scale_factor:
-        scale_factor = settings.fallback_scale_factor
-        method = "fallback factor"
+    scale_factor, method = select_scale(candidates)
+    if method == SCENE_PRIORS:
+        DETECTION_CONFIDENCE.observe(candidates[0].confidence)
 
     logger.info(f"Scale factor is {scale_factor:.5f} set using {method!r}.")
     SCALING_METHOD_TOTAL.labels(method=method).inc()
 
     depth_map *= scale_factor
+    INFERENCE_LATENCY.labels(component="scaling").observe(time.perf_counter() - start_time)
+
+    return image, AnalysisResult(depth_map, K, scale_factor, method, boxes, candidates=candidates)
+
+
+def resolve_target_points(
+    target_points: int | None = None,
+    target_bytes: int | None = None,
+) -> int | None:
+    """Return the tighter of a point and a payload budget as a number of points, if any is set."""
+    if target_points is None and target_bytes is None:
+        target_points, target_bytes = settings.target_points, settings.target_bytes
+
+    budgets = []
+    if target_points is not None:
+        budgets.append(target_points)
+    if target_bytes is not None:
+        budgets.append(target_bytes // POINT_SIZE)
+    return max(1, min(budgets)) if budgets else None
+
+
+def downsample_to_budget(
+    pcd: o3d.geometry.PointCloud,
+    voxel_size: float,
+    target_points: int,
+    min_size: float,
+    token: CancellationToken,
+    iterations: int = 4,
+    tolerance: float = 0.1,
+) -> tuple[o3d.geometry.PointCloud, float]:
+    """Voxel downsample a cloud to at most target_points, refining an estimated voxel size.
+
+    The voxel size is corrected from the observed count, assuming the points of a surface
+    shrink with the square of the voxel size, until the count is within tolerance below
+    the budget. If that doesn't happen in time, the best cloud within budget is kept, or
+    the last one is thinned to the budget.
+    """
+    best = None
+    for _ in range(iterations):
+        token.check("voxelization")
+        downsampled = pcd.voxel_down_sample(voxel_size=voxel_size)
+        count = len(downsampled.points)
+
+        if count <= target_points:
+            if best is None or count > len(best[0].points):
+                best = downsampled, voxel_size
+            if count >= target_points * (1 - tolerance) or voxel_size <= min_size:
+                break
+
+        # Aim a little below the budget, so the next try is likely to fit
+        voxel_size = max(min_size, voxel_size * float(np.sqrt(count / (target_points * (1 - tolerance / 2)))))
+
+    if best is not None:
+        return best
+
+    indices = np.linspace(0, count - 1, target_points).astype(np.int64)
+    return downsampled.select_by_index(indices), voxel_size
+
+
+def build_pcd(
+    image: np.ndarray,
+    result: AnalysisResult,
+    roi: tuple[int, int, int, int] | None = None,
+    voxel_size: float | None = None,
+    target_points: int | None = None,
+    token: CancellationToken | None = None,
+) -> tuple[o3d.geometry.PointCloud, float]:
+    """Back-project a metric depth map and return the colored, downsampled point cloud and its voxel size.
+
+    If an (x0, y0, x1, y1) region of interest is given, only that part of the image is
+    back-projected, in the same camera coordinates as the full image.
+
+    An explicit voxel size is used as is. Without one, a target point count picks the finest
+    voxel size that keeps the cloud within budget. The whole image is never made finer than
+    the default.
+    """
+    token = token or CancellationToken()
+    token.check("projection")
+
+    # Measure PCD projection latency
+    start_time = time.perf_counter()
+    depth_map, K = result.depth_map, result.K
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        image = image[y0:y1, x0:x1]
+        depth_map = depth_map[y0:y1, x0:x1]
+        K = crop_intrinsics(K, x0, y0)
+
     pcd_points = get_pcd_points(depth_map, K)
 
     colors = get_image_colors(image)
-    pcd = points_to_pcd(pcd_points, colors)
+    full_pcd = points_to_pcd(pcd_points, colors)
+
+    if voxel_size is None and target_points is not None:
+        min_size = settings.min_voxel_size if roi is not None else settings.voxel_size
+
+        token.check("voxel_estimate")
+        estimate_start = time.perf_counter()
+        voxel_size = estimate_voxel_size(pcd_points, depth_map.shape, target_points, min_size)
+        INFERENCE_LATENCY.labels(component="voxel_estimate").observe(time.perf_counter() - estimate_start)
+
+        token.check("voxelization")
+        pcd, voxel_size = downsample_to_budget(full_pcd, voxel_size, target_points, min_size, token)
+    else:
+        voxel_size = voxel_size if voxel_size is not None else settings.voxel_size
+        token.check("voxelization")
+        pcd = full_pcd.voxel_down_sample(voxel_size=voxel_size)
 
-    pcd = pcd.voxel_down_sample(voxel_size=settings.voxel_size)
     INFERENCE_LATENCY.labels(component="pcd_logic").observe(time.perf_counter() - start_time)
 
-    return pcd, scale_factor, method
+    return pcd, voxel_size
+
+
+def build_index(pcd: o3d.geometry.PointCloud) -> SpatialIndex:
+    """Build the spatial index of a downsampled point cloud and record its cost."""
+    index = SpatialIndex(np.asarray(pcd.points))
+    INFERENCE_LATENCY.labels(component="spatial_index").observe(index.build_time)
+    SPATIAL_INDEX_SIZE_BYTES.observe(index.nbytes)
+    return index
+
+
+def index_from_depth(result: AnalysisResult) -> SpatialIndex:
+    """Index the whole-image cloud of a result sent without one, as it would have been sent."""
+    pcd = points_to_pcd(get_pcd_points(result.depth_map, result.K))
+    return build_index(pcd.voxel_down_sample(voxel_size=settings.voxel_size))
+
+
+def depth_pcd(
+    image_file: BinaryIO,
+    midas: Callable,
+    midas_transforms: Callable,
+    yolo: YOLO
+) -> tuple[o3d.geometry.PointCloud, float, str]:
+    """Read image, extract intrinsics, calculate scale, and return downsampled point cloud."""
+    image, result = scaled_depth(image_file, midas, midas_transforms, yolo)
+    pcd, _ = build_pcd(image, result, target_points=resolve_target_points())
+    return pcd, result.scale_factor, result.method
 
 
 def pack_pointcloud(pcd: o3d.geometry.PointCloud) -> bytes:
@@ -143,7 +289,71 @@ def pack_pointcloud(pcd: o3d.geometry.PointCloud) -> bytes:
     return structured.tobytes()
 
 
-def precompute_samples(midas: Callable, transforms: Callable, yolo: YOLO) -> dict[str, str]:
+def encode_depth(
+    result: AnalysisResult,
+    roi: tuple[int, int, int, int] | None = None,
+    width: int | None = None,
+    result_id: str | None = None,
+) -> bytes:
+    """Pack the metric depth map at a working resolution, for back-projection by the client.
+
+    The payload is a little-endian uint32 header length, a JSON header with the intrinsics
+    of the sent grid and its quantization, and the depth as row-wise delta coded uint16
+    multiples of the depth step, where zero marks missing depth.
+    """
+    start_time = time.perf_counter()
+
+    depth_map, K = result.depth_map, result.K
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        depth_map = depth_map[y0:y1, x0:x1]
+        K = crop_intrinsics(K, x0, y0)
+
+    # Downscale with centered nearest sampling, so no depths are blended across edges
+    h, w = depth_map.shape
+    out_w = min(width or settings.depth_transport_width, w)
+    out_h = max(1, round(h * out_w / w))
+    sx, sy = out_w / w, out_h / h
+    depth_map = cv2.resize(depth_map, (out_w, out_h), interpolation=cv2.INTER_NEAREST_EXACT)
+    K = {
+        "fx": K["fx"] * sx, "fy": K["fy"] * sy,
+        "cx": (K["cx"] + 0.5) * sx - 0.5, "cy": (K["cy"] + 0.5) * sy - 0.5,
+    }
+
+    valid = np.isfinite(depth_map) & (depth_map > 0)
+    step = max(settings.depth_step, float(depth_map[valid].max(initial=0.0)) / 65535)
+    quantized = np.zeros(depth_map.shape, dtype=np.uint16)
+    quantized[valid] = np.clip(np.round(depth_map[valid] / step), 1, 65535)
+
+    # Neighbouring depths are close, and their small differences compress well
+    deltas = np.diff(quantized, axis=1, prepend=np.uint16(0))
+
+    header = json.dumps({
+        "width": out_w,
+        "height": out_h,
+        "K": K,
+        "roi": list(roi) if roi is not None else None,
+        "depth_step": step,
+        "encoding": "delta-u16",
+        "scale_factor": result.scale_factor,
+        "method": result.method,
+        "result_id": result_id,
+    }).encode()
+    # Pad so the depth array starts 2-byte aligned
+    header += b" " * (len(header) % 2)
+
+    payload = len(header).to_bytes(4, "little") + header + deltas.astype("<u2").tobytes()
+    INFERENCE_LATENCY.labels(component="depth_encoding").observe(time.perf_counter() - start_time)
+
+    return payload
+
+
+def precompute_samples(
+    midas: Callable,
+    transforms: Callable,
+    yolo: YOLO,
+    results: ResultStore | None = None,
+) -> dict[str, dict[str, str]]:
     if PRECOMP_DIR.exists():
         shutil.rmtree(PRECOMP_DIR)
 
@@ -154,16 +364,37 @@ def precompute_samples(midas: Callable, transforms: Callable, yolo: YOLO) -> dic
             continue
 
         with open(image_file, "br") as f:
-            pcd, scale_priors, method = depth_pcd(f, midas, transforms, yolo)
+            image, result = scaled_depth(f, midas, transforms, yolo)
+            pcd, voxel_size = build_pcd(image, result, target_points=resolve_target_points())
             buffer = gzip.compress(pack_pointcloud(pcd))
             metadata[image_file.name] = {
-                "X-Scaling-Factor": str(scale_priors),
-                "X-Scaling-Method": method,
+                "X-Scaling-Factor": str(result.scale_factor),
+                "X-Scaling-Method": result.method,
+                "X-Result-Id": image_file.name,
+                "X-Voxel-Size": f"{voxel_size:.4g}",
             }
 
+        # Keep sample results for measurements, they're never evicted
+        if results is not None:
+            result.index = build_index(pcd)
+            results.add(result, result_id=image_file.name, pinned=True)
+
         with open(PRECOMP_DIR / (image_file.stem + ".bytes"), "bw") as f:
             f.write(buffer)
 
         logger.info(f"Computed PCD points buffer for {str(image_file)!r} successfully.")
 
+    with open(SAMPLES_METADATA, "w") as f:
+        json.dump(metadata, f)
+
     return metadata
+
+
+def load_samples_metadata() -> dict[str, dict[str, str]]:
+    """Read the metadata of samples precomputed by another process."""
+    if not SAMPLES_METADATA.exists():
+        logger.warning(f"No precomputed samples found in {str(PRECOMP_DIR)!r}.")
+        return {}
+
+    with open(SAMPLES_METADATA) as f:
+        return json.load(f)
@@ -0,0 +1,189 @@
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import numpy as np
+
+from depth2metric.common.utils import get_logger
+from depth2metric.inference.scaling import ScaleCandidate
+from depth2metric.inference.spatial import SpatialIndex
+
+logger = get_logger(__name__)
+
+RESULT_ID_PATTERN = re.compile(r"[\w-][\w.-]*")
+
+
+@dataclass
+class AnalysisResult:
+    """Metric depth of an analyzed image, kept to answer later queries without rerunning inference."""
+    depth_map: np.ndarray
+    K: dict[str, float]
+    scale_factor: float
+    method: str
+    boxes: np.ndarray | None = None
+    index: SpatialIndex | None = None
+    candidates: list[ScaleCandidate] | None = None
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the result."""
+        return self.depth_map.nbytes + (self.index.nbytes if self.index is not None else 0)
+
+
+def save_result(result: AnalysisResult, path: Path) -> None:
+    """Write a result to a directory, replacing it atomically."""
+    tmp_path = path.parent / f".tmp-{uuid.uuid4().hex}"
+    tmp_path.mkdir(parents=True)
+
+    np.save(tmp_path / "depth.npy", result.depth_map.astype(np.float32, copy=False))
+    if result.boxes is not None:
+        np.save(tmp_path / "boxes.npy", result.boxes)
+    if result.index is not None:
+        np.save(tmp_path / "points.npy", result.index.points.astype(np.float32))
+
+    with open(tmp_path / "meta.json", "w") as f:
+        json.dump({
+            "K": result.K,
+            "scale_factor": result.scale_factor,
+            "method": result.method,
+            "candidates": [asdict(c) for c in result.candidates or []],
+        }, f)
+
+    if path.exists():
+        shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_result(path: Path) -> AnalysisResult:
+    """Read a result written by save_result, memory-mapping its depth map."""
+    with open(path / "meta.json") as f:
+        meta = json.load(f)
+
+    boxes = np.load(path / "boxes.npy") if (path / "boxes.npy").exists() else None
+    index = SpatialIndex(np.load(path / "points.npy")) if (path / "points.npy").exists() else None
+
+    return AnalysisResult(
+        depth_map=np.load(path / "depth.npy", mmap_mode="r"),
+        K=meta["K"],
+        scale_factor=meta["scale_factor"],
+        method=meta["method"],
+        boxes=boxes,
+        index=index,
+        candidates=[ScaleCandidate(**c) for c in meta["candidates"]],
+    )
+
+
+class ResultStore:
+    """Thread-safe LRU store of analysis results keyed by result id.
+
+    Results are cached in memory up to a count and a size in bytes. If a directory is
+    given, they're also written there, so every worker process sharing the directory can
+    answer queries about them. The directory keeps the max_size most recently used results.
+    """
+
+    def __init__(self, max_size: int, max_bytes: int | None = None, directory: str | None = None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.directory = Path(directory) if directory is not None else None
+        self.results: OrderedDict[str, AnalysisResult] = OrderedDict()
+        self.pinned: dict[str, AnalysisResult] = {}
+        self.lock = threading.Lock()
+
+        if self.directory is not None:
+            (self.directory / "pinned").mkdir(parents=True, exist_ok=True)
+            (self.directory / "cache").mkdir(parents=True, exist_ok=True)
+
+    def path(self, result_id: str, pinned: bool) -> Path:
+        assert self.directory is not None
+        return self.directory / ("pinned" if pinned else "cache") / result_id
+
+    def add(
+        self,
+        result: AnalysisResult,
+        result_id: str | None = None,
+        pinned: bool = False,
+    ) -> str:
+        """Store a result and return its id. Pinned results don't count towards the size limits."""
+        if result_id is None:
+            result_id = uuid.uuid4().hex
+
+        if self.directory is not None:
+            save_result(result, self.path(result_id, pinned))
+            if not pinned:
+                self.prune_directory()
+
+        with self.lock:
+            if pinned:
+                self.pinned[result_id] = result
+            else:
+                self.cache(result_id, result)
+
+        return result_id
+
+    def cache(self, result_id: str, result: AnalysisResult) -> None:
+        """Keep a result in memory, evicting the least recently used ones past the limits."""
+        self.results[result_id] = result
+        self.results.move_to_end(result_id)
+
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+        if self.max_bytes is not None:
+            total = sum(r.nbytes for r in self.results.values())
+            while total > self.max_bytes and len(self.results) > 1:
+                _, evicted = self.results.popitem(last=False)
+                total -= evicted.nbytes
+
+    def prune_directory(self) -> None:
+        """Remove the least recently used results of the shared directory past the size limit."""
+        assert self.directory is not None
+        entries = []
+        for path in (self.directory / "cache").iterdir():
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue # Removed by another worker
+
+        for _, path in sorted(entries)[:-self.max_size]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def get(self, result_id: str) -> AnalysisResult | None:
+        if RESULT_ID_PATTERN.fullmatch(result_id) is None:
+            return None
+
+        with self.lock:
+            if result_id in self.pinned:
+                return self.pinned[result_id]
+
+            result = self.results.get(result_id)
+            if result is not None:
+                self.results.move_to_end(result_id)
+                return result
+
+        if self.directory is None:
+            return None
+
+        # Stored by another worker (or evicted from memory)
+        for pinned in (True, False):
+            path = self.path(result_id, pinned)
+            try:
+                result = load_result(path)
+                if not pinned:
+                    os.utime(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+            with self.lock:
+                if pinned:
+                    self.pinned[result_id] = result
+                else:
+                    self.cache(result_id, result)
+            return result
+
+        return None
@@ -0,0 +1,138 @@
+import argparse
+import itertools
+import json
+import time
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from depth2metric.common.utils import get_logger
+from depth2metric.inference import models
+from depth2metric.inference.datasets import NYUDataset
+from depth2metric.inference.evaluation import compute_depth_metrics, pareto_front
+from depth2metric.inference.models import get_depth_map, get_midas
+
+logger = get_logger(__name__)
+
+# NYU depth PNGs in the Kaggle train split map 0-255 to 0-10 meters
+DEFAULT_DEPTH_SCALE = 10.0 / 255.0
+
+COLUMNS = ["model", "clipping", "cropping", "abs_rel", "rmse", "delta1", "latency_ms", "p95_ms", "throughput", "pareto"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Evaluate depth accuracy against latency on NYU depth.")
+    parser.add_argument("data_path", help="Directory containing the NYU CSV index and images.")
+    parser.add_argument("--csv-name", default="nyu2_train.csv")
+    parser.add_argument("--shards-dir", help="Read samples from pre-built shards (see `nyu-shards build`).")
+    parser.add_argument("--limit", type=int, default=50, help="Number of samples to evaluate (0 for all).")
+    parser.add_argument("--models", nargs="+", default=[models.settings.midas_model])
+    parser.add_argument("--clipping", nargs="+", choices=["on", "off"], default=["on"])
+    parser.add_argument("--cropping", nargs="+", choices=["on", "off"], default=["on"])
+    parser.add_argument("--depth-scale", type=float, default=DEFAULT_DEPTH_SCALE, help="Meters per ground truth unit.")
+    parser.add_argument("--invert-prediction", action="store_true", help="Treat the model output as disparity.")
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--json", dest="json_path", help="Write results to this JSON file.")
+    return parser.parse_args()
+
+
+def first_item(batch: list) -> tuple:
+    return batch[0]
+
+
+def evaluate_config(
+    loader: DataLoader,
+    midas,
+    transforms,
+    depth_scale: float,
+    invert_prediction: bool,
+) -> dict[str, float]:
+    """Run the production depth path over the loader and aggregate metrics and timings."""
+    totals = {"abs_rel": 0.0, "rmse": 0.0, "delta1": 0.0}
+    latencies = []
+
+    wall_start = time.perf_counter()
+    for color_image, _, depth_image, _ in loader:
+        start_time = time.perf_counter()
+        depth_map = get_depth_map(midas, transforms, color_image)
+        latencies.append(time.perf_counter() - start_time)
+
+        gt = depth_image.astype(np.float32) * depth_scale
+        if gt.ndim == 3:
+            gt = gt[..., 0]
+
+        if depth_map.shape != gt.shape:
+            depth_map = cv2.resize(depth_map, gt.shape[::-1], interpolation=cv2.INTER_LINEAR)
+
+        if invert_prediction:
+            depth_map = 1.0 / np.maximum(depth_map, 1e-6)
+
+        for key, value in compute_depth_metrics(depth_map, gt).items():
+            totals[key] += value
+    wall_time = time.perf_counter() - wall_start
+
+    n = len(latencies)
+    result = {key: value / n for key, value in totals.items()}
+    result["latency_ms"] = float(np.mean(latencies) * 1000)
+    result["p95_ms"] = float(np.percentile(latencies, 95) * 1000)
+    result["throughput"] = n / wall_time
+    return result
+
+
+def print_table(rows: list[dict]) -> None:
+    print(" | ".join(f"{col:>10}" for col in COLUMNS))
+    for row in rows:
+        cells = []
+        for col in COLUMNS:
+            value = row[col]
+            cells.append(f"{value:>10.4f}" if isinstance(value, float) else f"{str(value):>10}")
+        print(" | ".join(cells))
+
+
+def main():
+    args = parse_args()
+
+    dataset = NYUDataset(
+        args.data_path,
+        transforms=torch.nn.Identity(),
+        load_with_opencv=True,
+        csv_name=args.csv_name,
+        shards_dir=args.shards_dir,
+    )
+    if args.limit > 0:
+        dataset = Subset(dataset, range(min(args.limit, len(dataset))))
+
+    loader = DataLoader(
+        dataset,
+        batch_size=1,
+        num_workers=args.num_workers,
+        collate_fn=first_item,
+    )
+
+    rows = []
+    for model_name in args.models:
+        midas, transforms = get_midas(model_name)
+
+        for clipping, cropping in itertools.product(args.clipping, args.cropping):
+            models.settings.enable_percentile_clipping = clipping == "on"
+            models.settings.enable_edge_cropping = cropping == "on"
+
+            result = evaluate_config(loader, midas, transforms, args.depth_scale, args.invert_prediction)
+            row = {"model": model_name, "clipping": clipping, "cropping": cropping, **result}
+            rows.append(row)
+            logger.info(f"Evaluated {model_name} (clipping={clipping}, cropping={cropping}) on {len(dataset)} samples.")
+
+    for row, flag in zip(rows, pareto_front(rows, "latency_ms", "abs_rel")):
+        row["pareto"] = flag
+
+    print_table(rows)
+
+    if args.json_path is not None:
+        with open(args.json_path, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import subprocess
+import sys
+
+DEFAULT_MODULES = ["depth2metric.main", "depth2metric.scripts.precompute_samples"]
+
+# Heavy libraries that must only be loaded on first use
+DEFAULT_FORBIDDEN = ["matplotlib", "open3d", "scipy", "torch", "ultralytics"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Report per-module cumulative import time.")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--top", type=int, default=20, help="Number of slowest imports to show.")
+    parser.add_argument("--budget-ms", type=float, help="Fail if importing a module takes longer.")
+    parser.add_argument("--forbid", nargs="*", default=DEFAULT_FORBIDDEN, help="Fail if these get imported.")
+    return parser.parse_args()
+
+
+def measure_imports(module: str) -> list[tuple[str, float, float]]:
+    """Import a module in a fresh interpreter and return (name, self ms, cumulative ms) per import."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        errors = [line for line in proc.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError(f"Importing {module!r} failed:\n" + "\n".join(errors))
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        imports.append((name.strip(), int(self_us) / 1000, int(cumulative_us) / 1000))
+    return imports
+
+
+def main():
+    args = parse_args()
+    failed = False
+
+    for module in args.modules:
+        imports = measure_imports(module)
+        total = next(cumulative for name, _, cumulative in imports if name == module)
+
+        print(f"{module}: {total:.1f}ms")
+        print(f"{'cumulative':>12} {'self':>10}  module")
+        for name, self_ms, cumulative_ms in sorted(imports, key=lambda i: i[2], reverse=True)[:args.top]:
+            print(f"{cumulative_ms:>10.1f}ms {self_ms:>8.1f}ms  {name}")
+        print()
+
+        if args.budget_ms is not None and total > args.budget_ms:
+            print(f"{module} exceeds the import budget ({total:.1f}ms > {args.budget_ms:.1f}ms).")
+            failed = True
+
+        loaded = {name.split(".")[0] for name, _, _ in imports}
+        for forbidden in sorted(loaded.intersection(args.forbid)):
+            print(f"{module} eagerly imports {forbidden!r}.")
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import mimetypes
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+DEFAULT_CORPUS = "./static/samples"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the Depth2Metric HTTP API.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="Run the app with stub MiDaS and YOLO models.")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--workers", type=int, default=1)
+
+    run = subparsers.add_parser("run", help="Drive a running server and report latencies.")
+    run.add_argument("--url", default="http://localhost:8000")
+    run.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    run.add_argument("--requests", type=int, default=50, help="Requests per concurrency level.")
+    run.add_argument(
+        "--mix",
+        default="upload=1,sample=1",
+        help="Weighted request mix of 'upload' (POST /analyze) and 'sample' (POST /analyze/{filename}).",
+    )
+    run.add_argument("--corpus", default=DEFAULT_CORPUS, help="Directory of images to upload.")
+    run.add_argument(
+        "--samples",
+        nargs="+",
+        help="Sample names for 'sample' requests, fetched from the server by default.",
+    )
+    run.add_argument("--timeout", type=float, default=120.0)
+    run.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in ("upload", "sample"):
+            raise ValueError(f"Unknown request kind {kind!r}.")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def scrape_metrics(client: httpx.Client) -> dict[tuple, float]:
+    """Return counter, histogram and summary samples of /metrics keyed by name and labels."""
+    # Imported here, prometheus_client picks its value storage on first import and serve
+    # may run the app in this process after setting PROMETHEUS_MULTIPROC_DIR
+    from prometheus_client.parser import text_string_to_metric_families
+
+    response = client.get("/metrics")
+    response.raise_for_status()
+
+    samples = {}
+    for family in text_string_to_metric_families(response.text):
+        if family.type not in ("counter", "histogram", "summary"):
+            continue
+        for sample in family.samples:
+            if sample.name.endswith(("_total", "_sum", "_count")):
+                samples[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+    return samples
+
+
+def print_metrics_delta(before: dict[tuple, float], after: dict[tuple, float]) -> None:
+    print("Server metrics delta:")
+    for (name, labels), value in sorted(after.items()):
+        delta = value - before.get((name, labels), 0.0)
+        if delta == 0 or name.endswith("_sum"):
+            continue
+
+        label_text = ",".join(f"{k}={v}" for k, v in labels if k != "pid")
+        line = f"  {name}{{{label_text}}}: +{delta:g}"
+
+        # Show the average observation of histograms over the run
+        if name.endswith("_count"):
+            sum_key = (name.removesuffix("_count") + "_sum", labels)
+            total = after.get(sum_key, 0.0) - before.get(sum_key, 0.0)
+            line += f" (avg {total / delta:.4g})"
+        print(line)
+
+
+async def send_request(
+    client: httpx.AsyncClient,
+    kind: str,
+    image_path: Path,
+    sample: str,
+) -> tuple[str, float, int | None]:
+    start_time = time.perf_counter()
+    try:
+        if kind == "upload":
+            content_type = mimetypes.guess_type(image_path.name)[0] or "image/jpeg"
+            files = {"file": (image_path.name, image_path.read_bytes(), content_type)}
+            response = await client.post("/analyze", files=files)
+        else:
+            response = await client.post(f"/analyze/{sample}")
+        await response.aread()
+        status = response.status_code
+    except httpx.HTTPError:
+        status = None
+    return kind, time.perf_counter() - start_time, status
+
+
+async def run_level(
+    url: str,
+    concurrency: int,
+    requests: int,
+    mix: dict[str, float],
+    corpus: list[Path],
+    samples: list[str],
+    timeout: float,
+    rng: random.Random,
+) -> tuple[list[tuple[str, float, int | None]], float]:
+    """Send a number of requests with a fixed number in flight, returning results and wall time."""
+    plan = [
+        (rng.choices(list(mix), weights=list(mix.values()))[0], rng.choice(corpus), rng.choice(samples))
+        for _ in range(requests)
+    ]
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    results = []
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        async def worker():
+            while not queue.empty():
+                kind, image_path, sample = queue.get_nowait()
+                results.append(await send_request(client, kind, image_path, sample))
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start_time
+
+    return results, elapsed
+
+
+def print_report(concurrency: int, results: list[tuple[str, float, int | None]], elapsed: float) -> None:
+    by_kind = defaultdict(list)
+    for kind, latency, status in results:
+        by_kind[kind].append((latency, status))
+        by_kind["all"].append((latency, status))
+
+    print(f"Concurrency {concurrency}: {len(results)} requests in {elapsed:.2f}s ({len(results) / elapsed:.2f} req/s)")
+    print(f"  {'kind':>8} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7}")
+    for kind, items in sorted(by_kind.items()):
+        latencies = np.array([latency for latency, _ in items]) * 1000
+        errors = sum(1 for _, status in items if status is None or status >= 400)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(
+            f"  {kind:>8} {len(items):>6} {p50:>9.1f} {p90:>9.1f} {p99:>9.1f} "
+            f"{latencies.max():>9.1f} {errors / len(items):>6.1%}"
+        )
+    print()
+
+
+def run(args: argparse.Namespace) -> None:
+    mix = parse_mix(args.mix)
+    corpus = sorted(p for p in Path(args.corpus).glob("*") if p.suffix.lower() in (".jpg", ".jpeg", ".png"))
+    if not corpus:
+        raise SystemExit(f"No images found in {args.corpus!r}.")
+
+    rng = random.Random(args.seed)
+
+    with httpx.Client(base_url=args.url, timeout=args.timeout) as client:
+        samples = args.samples
+        if samples is None and mix.get("sample"):
+            response = client.get("/samples")
+            response.raise_for_status()
+            samples = response.json()
+        if mix.get("sample") and not samples:
+            raise SystemExit("The server has no samples for 'sample' requests.")
+
+        before = scrape_metrics(client)
+
+        for concurrency in args.concurrency:
+            results, elapsed = asyncio.run(
+                run_level(args.url, concurrency, args.requests, mix, corpus, samples or [""], args.timeout, rng)
+            )
+            print_report(concurrency, results, elapsed)
+
+        after = scrape_metrics(client)
+
+    print_metrics_delta(before, after)
+
+
+def serve(args: argparse.Namespace) -> None:
+    # Must be set before the settings are first parsed
+    os.environ["STUB_MODELS"] = "true"
+
+    import uvicorn
+
+    with tempfile.TemporaryDirectory(prefix="depth2metric-loadtest-") as tmp_dir:
+        # Aggregate metrics and share results across workers, unless already set up
+        os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tmp_dir, "prometheus"))
+        os.environ.setdefault("RESULTS_DIR", os.path.join(tmp_dir, "results"))
+        os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+        # Precompute the samples once, so the workers don't race to write them
+        env = {k: v for k, v in os.environ.items() if k != "PROMETHEUS_MULTIPROC_DIR"}
+        subprocess.run([sys.executable, "-m", "depth2metric.scripts.precompute_samples"], env=env, check=True)
+        os.environ["PRECOMPUTE_ON_STARTUP"] = "false"
+
+        uvicorn.run("depth2metric.main:app", host=args.host, port=args.port, workers=args.workers)
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "serve":
+        serve(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from depth2metric.common.utils import get_logger
+from depth2metric.inference.datasets import NYUDataset, build_shards
+
+logger = get_logger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build and benchmark memory-mapped NYU shards.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Decode the dataset once into shards.")
+    build.add_argument("data_path")
+    build.add_argument("shards_dir")
+    build.add_argument("--csv-name", default="nyu2_train.csv")
+    build.add_argument("--shard-size", type=int, default=1024)
+    build.add_argument("--num-workers", type=int, default=4)
+
+    bench = subparsers.add_parser("bench", help="Measure loader throughput in samples/s.")
+    bench.add_argument("data_path")
+    bench.add_argument("--shards-dir", help="Read from shards instead of decoding images.")
+    bench.add_argument("--csv-name", default="nyu2_train.csv")
+    bench.add_argument("--limit", type=int, default=1000)
+    bench.add_argument("--batch-size", type=int, default=16)
+    bench.add_argument("--num-workers", type=int, default=4)
+
+    return parser.parse_args()
+
+
+def bench(args: argparse.Namespace) -> float:
+    dataset = NYUDataset(
+        args.data_path,
+        load_with_opencv=True,
+        csv_name=args.csv_name,
+        shards_dir=args.shards_dir,
+    )
+    if args.limit > 0:
+        dataset = torch.utils.data.Subset(dataset, range(min(args.limit, len(dataset))))
+
+    loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+
+    count = 0
+    start_time = time.perf_counter()
+    for batch in loader:
+        count += len(batch[0])
+    elapsed = time.perf_counter() - start_time
+
+    throughput = count / elapsed
+    source = "shards" if args.shards_dir is not None else "images"
+    print(f"Loaded {count} samples from {source} in {elapsed:.2f}s ({throughput:.1f} samples/s).")
+    return throughput
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "build":
+        start_time = time.perf_counter()
+        index = build_shards(
+            args.data_path,
+            args.shards_dir,
+            csv_name=args.csv_name,
+            shard_size=args.shard_size,
+            num_workers=args.num_workers,
+        )
+        logger.info(
+            f"Wrote {index['count']} samples into {len(index['shards'])} shards "
+            f"at {args.shards_dir!r} in {time.perf_counter() - start_time:.1f}s."
+        )
+    else:
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()
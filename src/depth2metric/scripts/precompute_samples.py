@@ -1,11 +1,21 @@
+from depth2metric.common.settings import get_settings
 from depth2metric.inference.models import get_midas, get_yolo
 from depth2metric.pipeline import precompute_samples
+from depth2metric.results import ResultStore
+
+settings = get_settings()
 
 
 def main():
     midas, transforms = get_midas()
     yolo = get_yolo()
-    precompute_samples(midas, transforms, yolo)
+
+    # Pin the sample results in the shared directory, for the workers to load
+    results = None
+    if settings.results_dir is not None:
+        results = ResultStore(settings.result_cache_size, settings.result_cache_bytes, settings.results_dir)
+
+    precompute_samples(midas, transforms, yolo, results)
 
 
 if __name__ == "__main__":
@@ -19,6 +19,9 @@ const state = {
     isMeasurementAllowed: false,
     currentDistance: 0,
 
+    // 'depth' receives the scaled depth map and back-projects it here, 'points' receives a packed cloud
+    output: 'depth',
+
     // Interaction
     longPressTimer: null,
     longPressOrigin: null,
@@ -181,22 +184,29 @@ async function handleProcessStart(processFn) {
 }
 
 async function loadSample(filename) {
-    const response = await fetch(`/analyze/${filename}`, { method: 'POST' });
-    await processAnalyzeResponse(response);
+    const formData = new FormData();
+    formData.append('output', state.output);
+
+    const response = await fetch(`/analyze/${filename}`, {
+        method: 'POST',
+        body: formData
+    });
+    await processAnalyzeResponse(response, () => fetch(`/static/samples/${filename}`).then(r => r.blob()));
 }
 
 async function uploadImage(file) {
     const formData = new FormData();
     formData.append('file', file);
+    formData.append('output', state.output);
 
     const response = await fetch('/analyze', {
         method: 'POST',
         body: formData
     });
-    await processAnalyzeResponse(response);
+    await processAnalyzeResponse(response, async () => file);
 }
 
-async function processAnalyzeResponse(response) {
+async function processAnalyzeResponse(response, getImage) {
     if (!response.ok) {
         let errorMsg = "Server error";
         try {
@@ -214,7 +224,11 @@ async function processAnalyzeResponse(response) {
     }
 
     const buffer = await response.arrayBuffer();
-    handlePCD(buffer);
+    if (response.headers.get('X-Output') === 'depth') {
+        await handleDepth(buffer, await getImage());
+    } else {
+        handlePCD(buffer);
+    }
 }
 
 /**
@@ -246,6 +260,68 @@ function handlePCD(buffer) {
     state.isMeasurementAllowed = true;
 }
 
+async function handleDepth(buffer, image) {
+    // Layout: u32 header length, JSON header, row-wise delta coded u16 depth (0 = missing)
+    const headerLength = new DataView(buffer).getUint32(0, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+    const { width, height, K, roi, depth_step: step } = header;
+
+    const deltas = new Uint16Array(buffer, 4 + headerLength, width * height);
+    const pixels = await getImagePixels(image, width, height, roi);
+
+    // Per-column and per-row ray factors, so each pixel costs two multiplications
+    const rayX = new Float32Array(width);
+    for (let u = 0; u < width; u++) rayX[u] = (u - K.cx) / K.fx;
+    const rayY = new Float32Array(height);
+    for (let v = 0; v < height; v++) rayY[v] = -(v - K.cy) / K.fy;
+
+    const points = new Float32Array(width * height * 3);
+    const colors = new Uint8Array(width * height * 3);
+    let count = 0;
+
+    for (let v = 0; v < height; v++) {
+        let quantized = 0;
+        for (let u = 0; u < width; u++) {
+            const i = v * width + u;
+            quantized = (quantized + deltas[i]) & 0xffff;
+            if (quantized === 0) continue;
+
+            const depth = quantized * step;
+            points[count * 3 + 0] = rayX[u] * depth;
+            points[count * 3 + 1] = rayY[v] * depth;
+            points[count * 3 + 2] = depth;
+
+            colors[count * 3 + 0] = pixels[i * 4 + 0];
+            colors[count * 3 + 1] = pixels[i * 4 + 1];
+            colors[count * 3 + 2] = pixels[i * 4 + 2];
+            count++;
+        }
+    }
+    if (count === 0) throw new Error("Received an empty depth map.");
+
+    clearMeasurement();
+    renderPointCloud(points.slice(0, count * 3), colors.slice(0, count * 3));
+    state.isMeasurementAllowed = true;
+}
+
+async function getImagePixels(image, width, height, roi) {
+    // Sample the image on the same grid as the depth map, cropped to the region if any
+    const options = { resizeWidth: width, resizeHeight: height, resizeQuality: 'pixelated' };
+    const bitmap = roi
+        ? await createImageBitmap(image, roi[0], roi[1], roi[2] - roi[0], roi[3] - roi[1], options)
+        : await createImageBitmap(image, options);
+
+    const canvas = document.createElement('canvas');
+    canvas.width = width;
+    canvas.height = height;
+
+    const context = canvas.getContext('2d');
+    context.drawImage(bitmap, 0, 0);
+    bitmap.close();
+
+    return context.getImageData(0, 0, width, height).data;
+}
+
 function renderPointCloud(points, colors) {
     if (state.pointCloud) {
         state.scene.remove(state.pointCloud);